@@ -154,6 +154,11 @@ parser.add_argument('--save_ckpt', type=str2bool, default=False)
 parser.add_argument('--tag', default='', type=str, help='name of experiment')
 parser.add_argument('--test', action='store_true', help='for debugging, do not save results')
 parser.add_argument('--time', action='store_true', help='measuring time for each step')
+parser.add_argument('--registry',
+                    type=str2bool,
+                    default=False,
+                    help='skip or resume runs with identical arguments and code (see misc/registry.py)')
+parser.add_argument('--rerun', action='store_true', help='condense again even if the run is registered')
 
 # Condense
 parser.add_argument('-i', '--ipc', type=int, default=-1, help='number of condensed data per class')
@@ -182,6 +187,14 @@ parser.add_argument('-a',
                     type=str,
                     default='color_crop_cutout',
                     help='augmentation strategy for condensation matching objective')
+parser.add_argument('--aug_fused',
+                    type=str2bool,
+                    default=False,
+                    help='resample geometric augmentations once with a composed affine matrix')
+parser.add_argument('--aug_stream',
+                    type=int,
+                    default=0,
+                    help='pre-generate matching augmentation parameters in blocks of this many steps')
 ## Matching objective
 parser.add_argument('--match',
                     type=str,
@@ -244,6 +257,58 @@ parser.add_argument('-s',
                     default='idc',
                     help='data condensation type (idc, dsa, kip, random, herding)')
 parser.add_argument('--repeat', default=1, type=int, help='number of test repetetion')
+parser.add_argument('--repeat_ci',
+                    type=float,
+                    default=0,
+                    help='repeat tests (with repeat > 1) until the 95%% CI of the mean best acc is below this (0: off)')
+parser.add_argument('--repeat_max', type=int, default=10, help='maximum number of adaptive repeats')
+parser.add_argument('--eval_cache',
+                    type=str2bool,
+                    default=False,
+                    help='reuse evaluation results of identical condensed data and arguments')
+parser.add_argument('--ensemble',
+                    type=str2bool,
+                    default=False,
+                    help='train the repeated evaluation models together with stacked parameters (vmap)')
+parser.add_argument('--val_subset',
+                    type=int,
+                    default=0,
+                    help='validate on a stratified subset of this size except at the last epoch (0: full)')
+parser.add_argument('--val_subset_seed', type=int, default=0, help='seed of the validation subset')
+parser.add_argument('--val_full_best',
+                    type=str2bool,
+                    default=False,
+                    help='confirm new best models on the full validation set')
+parser.add_argument('--fast_eval',
+                    type=str2bool,
+                    default=False,
+                    help='stop the evaluation of intermediate condensed data by learning-curve fit')
+parser.add_argument('--fast_eval_tol',
+                    type=float,
+                    default=0.5,
+                    help='stop when the extrapolated final accuracy is within this margin (%%)')
+parser.add_argument('--fast_eval_num_val',
+                    type=int,
+                    default=20,
+                    help='number of validations for the learning curve in fast evaluation')
+parser.add_argument('--proxy',
+                    type=str,
+                    default='none',
+                    choices=['none', 'kernel', 'linear'],
+                    help='proxy evaluation of condensed data (kernel: random ConvNet KRR, '
+                    'linear: linear probe on pretrained features)')
+parser.add_argument('--probe_ckpt',
+                    type=str,
+                    default='pool',
+                    help='backbone of the linear probe (pool, herding, or a checkpoint path)')
+parser.add_argument('--parallel_eval',
+                    type=str2bool,
+                    default=False,
+                    help='evaluate the test architectures concurrently in worker processes')
+parser.add_argument('--eval_workers',
+                    type=int,
+                    default=0,
+                    help='number of evaluation workers sharing the GPUs (0: one per architecture, up to CPU cores)')
 parser.add_argument('--dsa',
                     type=str2bool,
                     default=False,
@@ -258,6 +323,15 @@ parser.add_argument('--same_compute',
                     default=False,
                     help='match evaluation training steps for IDC')
 parser.add_argument('--name', type=str, default='', help='name of the test data folder')
+parser.add_argument('--val_cache',
+                    type=str,
+                    default='uint8',
+                    choices=['none', 'uint8', 'half'],
+                    help='keep the preprocessed validation set on GPUs (storage type)')
+parser.add_argument('--val_batch_size',
+                    type=int,
+                    default=500,
+                    help='mini-batch size for the cached validation set')
 parser.add_argument('--dp', type=str, choices=['none', 'A', 'B'], default='none',
                     help='Differential privacy setting. A is deprecated. B is questionable. C is preferable')
 parser.add_argument('--dp-a', action='store_true', help='whether to add noise to the first stage')
@@ -329,6 +403,9 @@ if args.dataset == 'imagenet':
         args.weight_decay = 1e-4
         args.batch_size = max(128, args.batch_size)
         args.batch_real = max(128, args.batch_real)
+    if args.nclass > 100:
+        # Full ImageNet validation set does not fit on GPU memory
+        args.val_cache = 'none'
 
 if args.dataset == 'speech':
     args.nch = 1
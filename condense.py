@@ -1,23 +1,25 @@
 import os
+import copy
+import hashlib
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
-import torch.nn.functional as F
 from torchvision import datasets, transforms
 from data import transform_imagenet, transform_cifar, transform_svhn, transform_mnist, transform_fashion
 from data import TensorDataset, ImageFolder, save_img
-from data import ClassDataLoader, ClassMemDataLoader, MultiEpochsDataLoader
+from data import ClassDataLoader, ClassMemDataLoader, MultiEpochsDataLoader, TensorMemDataLoader
 from data import MEANS, STDS
 from train import define_model, train_epoch
 from test import test_data, load_ckpt
+from proxy import proxy_eval
 from misc.augment import DiffAug
 from misc import utils
+from misc import formation
 import math
-from math import ceil
 import glob
 from utils import get_strategy
-from data import Data
+from data import Data, dataset_key
 from get_dp import get_noise_multiplier
 class Synthesizer():
     """Condensed data class
@@ -46,7 +48,8 @@ class Synthesizer():
 
         self.factor = max(1, args.factor)
         self.decode_type = args.decode_type
-        self.resize = nn.Upsample(size=self.size, mode='bilinear')
+        # Decoded data loader keyed by the content of the synthetic data
+        self.cache = (None, None)
         print(f"Factor: {self.factor} ({self.decode_type})")
 
 
@@ -66,24 +69,8 @@ class Synthesizer():
             for c in range(self.nclass):
                 img, _ = loader.class_sample(c, self.ipc * self.factor**2)
                 img = img.data.to(self.device)
-
-                s = self.size[0] // self.factor
-                remained = self.size[0] % self.factor
-                k = 0
                 n = self.ipc
-
-                h_loc = 0
-                for i in range(self.factor):
-                    h_r = s + 1 if i < remained else s
-                    w_loc = 0
-                    for j in range(self.factor):
-                        w_r = s + 1 if j < remained else s
-                        img_part = F.interpolate(img[k * n:(k + 1) * n], size=(h_r, w_r))
-                        self.data.data[n * c:n * (c + 1), :, h_loc:h_loc + h_r,
-                                       w_loc:w_loc + w_r] = img_part
-                        w_loc += w_r
-                        k += 1
-                    h_loc += h_r
+                self.data.data[n * c:n * (c + 1)] = formation.encode(img, self.size[0], self.factor)
 
         elif init_type == 'noise':
             pass
@@ -101,86 +88,16 @@ class Synthesizer():
 
         return data, target
 
-    def decode_zoom(self, img, target, factor):
-        """Uniform multi-formation
-        """
-        h = img.shape[-1]
-        remained = h % factor
-        if remained > 0:
-            img = F.pad(img, pad=(0, factor - remained, 0, factor - remained), value=0.5)
-        s_crop = ceil(h / factor)
-        n_crop = factor**2
-
-        cropped = []
-        for i in range(factor):
-            for j in range(factor):
-                h_loc = i * s_crop
-                w_loc = j * s_crop
-                cropped.append(img[:, :, h_loc:h_loc + s_crop, w_loc:w_loc + s_crop])
-        cropped = torch.cat(cropped)
-        data_dec = self.resize(cropped)
-        target_dec = torch.cat([target for _ in range(n_crop)])
-
-        return data_dec, target_dec
-
-    def decode_zoom_multi(self, img, target, factor_max):
-        """Multi-scale multi-formation
-        """
-        data_multi = []
-        target_multi = []
-        for factor in range(1, factor_max + 1):
-            decoded = self.decode_zoom(img, target, factor)
-            data_multi.append(decoded[0])
-            target_multi.append(decoded[1])
-
-        return torch.cat(data_multi), torch.cat(target_multi)
-
-    def decode_zoom_bound(self, img, target, factor_max, bound=128):
-        """Uniform multi-formation with bounded number of synthetic data
-        """
-        bound_cur = bound - len(img)
-        budget = len(img)
-
-        data_multi = []
-        target_multi = []
-
-        idx = 0
-        decoded_total = 0
-        for factor in range(factor_max, 0, -1):
-            decode_size = factor**2
-            if factor > 1:
-                n = min(bound_cur // decode_size, budget)
-            else:
-                n = budget
-
-            decoded = self.decode_zoom(img[idx:idx + n], target[idx:idx + n], factor)
-            data_multi.append(decoded[0])
-            target_multi.append(decoded[1])
-
-            idx += n
-            budget -= n
-            decoded_total += n * decode_size
-            bound_cur = bound - decoded_total - budget
-
-            if budget == 0:
-                break
-
-        data_multi = torch.cat(data_multi)
-        target_multi = torch.cat(target_multi)
-        return data_multi, target_multi
-
-    def decode(self, data, target, bound=128):
+    def decode(self, data, target, bound=128, nclass=1):
         """Multi-formation
         """
-        if self.factor > 1:
-            if self.decode_type == 'multi':
-                data, target = self.decode_zoom_multi(data, target, self.factor)
-            elif self.decode_type == 'bound':
-                data, target = self.decode_zoom_bound(data, target, self.factor, bound=bound)
-            else:
-                data, target = self.decode_zoom(data, target, self.factor)
-
-        return data, target
+        return formation.decode(data,
+                                target,
+                                self.factor,
+                                decode_type=self.decode_type,
+                                bound=bound,
+                                size=self.size[0],
+                                nclass=nclass)
 
     def sample(self, c, max_size=128):
         """Sample synthetic data per class
@@ -212,40 +129,45 @@ class Synthesizer():
         elif args.dataset == 'fashion':
             train_transform, _ = transform_fashion(augment=augment, from_tensor=True)
 
-        data_dec = []
-        target_dec = []
-        for c in range(self.nclass):
-            idx_from = self.ipc * c
-            idx_to = self.ipc * (c + 1)
-            data = self.data[idx_from:idx_to].detach()
-            target = self.targets[idx_from:idx_to].detach()
-            data, target = self.decode(data, target)
-
-            data_dec.append(data)
-            target_dec.append(target)
+        key = (formation.tensor_hash(self.data, self.targets), augment, args.batch_size)
+        if self.cache[0] == key:
+            return self.cache[1]
 
-        data_dec = torch.cat(data_dec)
-        target_dec = torch.cat(target_dec)
+        data_dec, target_dec = self.decode(self.data.detach(),
+                                           self.targets.detach(),
+                                           nclass=self.nclass)
 
         train_dataset = TensorDataset(data_dec.cpu(), target_dec.cpu(), train_transform)
 
         print("Decode condensed data: ", data_dec.shape)
-        nw = 0 if not augment else args.workers
-        train_loader = MultiEpochsDataLoader(train_dataset,
-                                             batch_size=args.batch_size,
-                                             shuffle=True,
-                                             num_workers=nw,
-                                             persistent_workers=nw > 0)
+        # Keep the condensed data on GPUs and augment each batch
+        train_loader = TensorMemDataLoader(train_dataset,
+                                           batch_size=args.batch_size,
+                                           device=self.device)
+        self.cache = (key, train_loader)
         return train_loader
 
-    def test(self, args, val_loader, logger, bench=True):
-        """Condensed data evaluation
+    def test(self, args, val_loader, logger, bench=True, fast_eval=False, proxy='none'):
+        """Condensed data evaluation (fast_eval: stop by learning-curve extrapolation,
+           proxy: evaluate with a proxy in proxy.py instead of training networks)
         """
+        if proxy != 'none':
+            data, target = self.decode(self.data.detach(), self.targets.detach(), nclass=self.nclass)
+            args_proxy = copy.copy(args)
+            args_proxy.proxy = proxy
+            proxy_eval(args_proxy, data, target, val_loader, logger=logger)
+            return
+
         loader = self.loader(args, args.augment)
-        test_data(args, loader, val_loader, test_resnet=False, logger=logger)
+        test_data(args, loader, val_loader, test_resnet=False, logger=logger, fast_eval=fast_eval)
 
         if bench and not (args.dataset in ['mnist', 'fashion']):
-            test_data(args, loader, val_loader, test_resnet=True, logger=logger)
+            test_data(args,
+                      loader,
+                      val_loader,
+                      test_resnet=True,
+                      logger=logger,
+                      fast_eval=fast_eval)
 
 
 def load_resized_data(args):
@@ -361,14 +283,17 @@ def diffaug(args, device='cuda'):
     aug_type = args.aug_type
     normalize = utils.Normalize(mean=MEANS[args.dataset], std=STDS[args.dataset], device=device)
     print("Augmentataion Matching: ", aug_type)
-    augment = DiffAug(strategy=aug_type, batch=True)
-    aug_batch = transforms.Compose([normalize, augment])
+    augment = DiffAug(strategy=aug_type, batch=True, fused=args.aug_fused)
+    if args.aug_stream > 0:
+        seed = args.seed if args.seed > 0 else np.random.randint(2**31)
+        augment.set_stream(seed, block=args.aug_stream, device=device)
+    aug_batch = utils.Compose([normalize, augment])
 
     if args.mixup_net == 'cut':
         aug_type = remove_aug(aug_type, 'cutout')
     print("Augmentataion Net update: ", aug_type)
-    augment_rand = DiffAug(strategy=aug_type, batch=False)
-    aug_rand = transforms.Compose([normalize, augment_rand])
+    augment_rand = DiffAug(strategy=aug_type, batch=False, fused=args.aug_fused)
+    aug_rand = utils.Compose([normalize, augment_rand])
 
     return aug_batch, aug_rand
 
@@ -491,8 +416,9 @@ def pretrain_sample(args, model, verbose=False):
     load_ckpt(model, file_dir, verbose=verbose)
 
 
-def condense(args, logger, device='cuda'):
-    """Optimize condensed data
+def condense(args, logger, device='cuda', start_iter=0, resume_path=None):
+    """Optimize condensed data.
+       With resume_path, the condensed data saved at iteration start_iter is loaded and optimized further.
     """
     # Define real dataset and loader
     if args.dp_a or args.dp_b:
@@ -568,8 +494,18 @@ def condense(args, logger, device='cuda'):
     #                 optim_net,
     #                 aug=aug_rand,
     #                 mixup=args.mixup_net)
-    strategy_init = get_strategy('KMeansSampling')(dataset, model)
-    if args.init == 'kmean':
+    # Embeddings of the initial model are cached for the kmean initialization.
+    # Unseeded models are never reused, so their embeddings are not cached.
+    init_key = None
+    if args.seed > 0:
+        init_key = repr((dataset_key(trainset), args.size, utils.hash_state(model.state_dict())))
+        init_key = f'{args.dataset}_kmean_' + hashlib.sha1(init_key.encode()).hexdigest()
+    strategy_init = get_strategy('KMeansSampling')(dataset, model, cache_key=init_key)
+    if resume_path is not None:
+        print(f"Resume synset from {resume_path}")
+        data, _ = torch.load(resume_path)
+        synset.data.data = data.to(synset.device)
+    elif args.init == 'kmean':
         print("Kmean initialize synset")
         for c in range(synset.nclass):
             synset.data.data[c*synset.ipc:(c+1)*synset.ipc] = get_init_images(c, synset.ipc).detach().data
@@ -588,23 +524,8 @@ def condense(args, logger, device='cuda'):
                 img = get_init_images(c, synset.ipc * synset.factor**2).detach()
                 img = img.data.to(synset.device)
 
-            s = synset.size[0] // synset.factor
-            remained = synset.size[0] % synset.factor
-            k = 0
             n = synset.ipc
-
-            h_loc = 0
-            for i in range(synset.factor):
-                h_r = s + 1 if i < remained else s
-                w_loc = 0
-                for j in range(synset.factor):
-                    w_r = s + 1 if j < remained else s
-                    img_part = F.interpolate(img[k * n:(k + 1) * n], size=(h_r, w_r))
-                    synset.data.data[n * c:n * (c + 1), :, h_loc:h_loc + h_r,
-                                    w_loc:w_loc + w_r] = img_part
-                    w_loc += w_r
-                    k += 1
-                h_loc += h_r
+            synset.data.data[n * c:n * (c + 1)] = formation.encode(img, synset.size[0], synset.factor)
 
     elif args.init == 'noise':
         pass
@@ -623,8 +544,13 @@ def condense(args, logger, device='cuda'):
              unnormalize=True,
              dataname=args.dataset)
     print("condense begin")
-    if not args.test:
-        synset.test(args, val_loader, logger, bench=False)
+    if not args.test and resume_path is None:
+        synset.test(args,
+                    val_loader,
+                    logger,
+                    bench=False,
+                    fast_eval=args.fast_eval,
+                    proxy=args.proxy)
     
     # Data distillation
     optim_img = torch.optim.SGD(synset.parameters(), lr=args.lr_img, momentum=args.mom_img)
@@ -637,7 +563,9 @@ def condense(args, logger, device='cuda'):
     logger(f"\nStart condensing with {args.match} matching for {n_iter} iteration")
     args.fix_iter = max(1, args.fix_iter)
     grads_accumulator = [[torch.zeros_like(param) for param in synset.parameters()] for c in range(nclass)]
-    for it in range(n_iter):
+    if start_iter > 0:
+        logger(f"Resume from iteration {start_iter}")
+    for it in range(start_iter, n_iter):
         if it % args.fix_iter == 0 and it != 0:
             model = define_model(args, nclass).to(device)
             model.train()
@@ -682,15 +610,22 @@ def condense(args, logger, device='cuda'):
                 img_syn, lab_syn = synset.sample(c, max_size=args.batch_syn_max)
                 ts.stamp("data")
                 n = img.shape[0]
-                img_aug = aug(torch.cat([img, img_syn]))
+                if args.aug_stream > 0:
+                    # Real and synthetic halves share the parameters of this step
+                    s = step * nclass + c
+                    img_real_aug = aug(img, step=s)
+                    img_syn_aug = aug(img_syn, step=s)
+                else:
+                    img_aug = aug(torch.cat([img, img_syn]))
+                    img_real_aug, img_syn_aug = img_aug[:n], img_aug[n:]
                 ts.stamp("aug")
                 #print('Gradient Part B batch_size: ', lab_syn.shape)
                 #print('Gradient Part B num_iter: ', args.inner_loop * nclass)
                 if args.stat:
-                    loss, grads = matchloss(args, img_aug[:n], img_aug[n:], lab, lab_syn, model)
+                    loss, grads = matchloss(args, img_real_aug, img_syn_aug, lab, lab_syn, model)
                     stat_a_ls.append(grads.detach().norm().item())
                 else:
-                    loss = matchloss(args, img_aug[:n],  img_aug[n:], lab, lab_syn, model)
+                    loss = matchloss(args, img_real_aug, img_syn_aug, lab, lab_syn, model)
                 loss_total += loss.item()
                 ts.stamp("loss")
                 # optim_img.zero_grad()
@@ -777,7 +712,14 @@ def condense(args, logger, device='cuda'):
             print("img and data saved!")
 
             if not args.test:
-                synset.test(args, val_loader, logger)
+                # Intermediate snapshots may use the fast evaluation or a proxy,
+                # the final one is fully trained
+                final = it + 1 >= n_iter
+                synset.test(args,
+                            val_loader,
+                            logger,
+                            fast_eval=args.fast_eval and not final,
+                            proxy='none' if final else args.proxy)
 
 if __name__ == '__main__':
     import shutil
@@ -785,9 +727,20 @@ if __name__ == '__main__':
     from argument import args
     import torch.backends.cudnn as cudnn
     import json
+    from misc import registry
 
     assert args.ipc > 0
 
+    start_iter, resume_path = 0, None
+    if args.registry and not args.test:
+        state, run_dir, start_iter, resume_path = registry.claim(args, rerun=args.rerun)
+        if state in ['done', 'running']:
+            print(f"Skip {state} run: {run_dir} ({args.save_dir})")
+            exit()
+        if not registry.link(args.save_dir, run_dir):
+            print(f"{args.save_dir} exists, results are saved in {run_dir}")
+        args.save_dir = run_dir
+
     cudnn.benchmark = True
     if args.seed > 0:
         np.random.seed(args.seed)
@@ -798,9 +751,11 @@ if __name__ == '__main__':
     cur_file = os.path.join(os.getcwd(), __file__)
     shutil.copy(cur_file, args.save_dir)
 
-    logger = Logger(args.save_dir)
+    logger = Logger(args.save_dir, mode='a' if resume_path is not None else 'w')
     logger(f"Save dir: {args.save_dir}")
     with open(os.path.join(args.save_dir, 'args.txt'), 'w') as f:
         json.dump(args.__dict__, f, indent=2)
 
-    condense(args, logger)
\ No newline at end of file
+    condense(args, logger, start_iter=start_iter, resume_path=resume_path)
+    if args.registry and not args.test:
+        registry.finish(args.save_dir)
\ No newline at end of file
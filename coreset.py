@@ -1,11 +1,13 @@
 import torch
 import os
+import hashlib
 from train import define_model
 from data import transform_cifar, transform_imagenet, transform_svhn, ImageFolder
-from data import MultiEpochsDataLoader, save_img, TensorDataset
+from data import MultiEpochsDataLoader, save_img, TensorDataset, dataset_key
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
+from misc import utils
 
 
 def remove_prefix_checkpoint(dictionary, prefix):
@@ -28,6 +30,29 @@ def load_ckpt(model, file_dir, verbose=True):
         print(f"\n=> loaded checkpoint '{file_dir}'")
 
 
+def herding_ckpt(args):
+    """Path of the pretrained model used for herding
+    """
+    if args.dataset == 'imagenet':
+        if args.nclass == 100:
+            file_dir = f'./results/imagenet-100/resnet10apin_cut_rrc_wd0.0001/model_best.pth.tar'
+        elif args.nclass == 10:
+            file_dir = f'./results/imagenet-10/resnet10apin_cut/model_best.pth.tar'
+        else:
+            raise AssertionError("Models not exist!")
+    elif args.dataset == 'cifar10':
+        file_dir = f'./results/cifar10/conv3in_cut/CIFAR10_ConvNet_Feature_dsa_cut.pt'
+    elif args.dataset == 'svhn':
+        if args.net_type == 'convnet':
+            file_dir = f'./results/svhn/conv3in_cut/model_best.pth.tar'
+        else:
+            file_dir = f'./results/svhn/resnet10_cut/model_best.pth.tar'
+    else:
+        raise AssertionError("Dataset is not supported!")
+
+    return file_dir
+
+
 def load_pretrained_herding(args):
     model = define_model(args, args.nclass).cuda()
     if args.dataset == 'imagenet':
@@ -46,12 +71,6 @@ def load_pretrained_herding(args):
                                   nclass=args.nclass,
                                   seed=args.dseed,
                                   load_memory=False)
-        if args.nclass == 100:
-            file_dir = f'./results/imagenet-100/resnet10apin_cut_rrc_wd0.0001/model_best.pth.tar'
-        elif args.nclass == 10:
-            file_dir = f'./results/imagenet-10/resnet10apin_cut/model_best.pth.tar'
-        else:
-            raise AssertionError("Models not exist!")
 
     elif args.dataset == 'cifar10':
         _, test_transform = transform_cifar(augment=args.augment, from_tensor=False)
@@ -63,7 +82,6 @@ def load_pretrained_herding(args):
         val_dataset = torchvision.datasets.CIFAR10(args.data_dir,
                                                    train=False,
                                                    transform=test_transform)
-        file_dir = f'./results/cifar10/conv3in_cut/CIFAR10_ConvNet_Feature_dsa_cut.pt'
 
     elif args.dataset == 'svhn':
         _, test_transform = transform_svhn(augment=args.augment, from_tensor=False)
@@ -75,14 +93,11 @@ def load_pretrained_herding(args):
         val_dataset = torchvision.datasets.SVHN(os.path.join(args.data_dir, 'svhn'),
                                                 split='test',
                                                 transform=test_transform)
-        if args.net_type == 'convnet':
-            file_dir = f'./results/svhn/conv3in_cut/model_best.pth.tar'
-        else:
-            file_dir = f'./results/svhn/resnet10_cut/model_best.pth.tar'
 
     else:
         raise AssertionError("Dataset is not supported!")
 
+    file_dir = herding_ckpt(args)
     loader = MultiEpochsDataLoader(train_dataset,
                                    batch_size=args.batch_size // 2,
                                    shuffle=False,
@@ -90,10 +105,25 @@ def load_pretrained_herding(args):
                                    persistent_workers=args.workers > 0)
     load_ckpt(model, file_dir)
 
-    return train_dataset, val_dataset, loader, model
+    return train_dataset, val_dataset, loader, model, file_dir
+
 
+def get_features(model, f_idx, loader, cache_key=None):
+    """Extract features. With a cache key, features are streamed to (or loaded from)
+       a memory-mapped cache on disk instead of being accumulated on GPU.
+    """
+    if cache_key is not None:
+        def extract():
+            with torch.no_grad():
+                model.eval()
+                for input, target in loader:
+                    input = input.cuda(non_blocking=True)
+                    yield model.get_feature(input, f_idx)[0], target
+
+        features, targets = utils.cached_features(cache_key, extract(), len(loader.dataset))
+        print("Feature shape: ", features.shape)
+        return features, targets
 
-def get_features(model, f_idx, loader):
     # Get features
     features = []
     targets = []
@@ -131,33 +161,80 @@ def randomselect(dataset, ipc, nclass, targets=None):
     return indices
 
 
-def herding_select(args, features, targets, descending=False):
-    # Herding
-    indices_slct = []
-    indices_full = torch.arange(len(features))
-    for c in range(args.nclass):
-        indices = targets == c
-        feature_c = features[indices]
-        indices_c = indices_full[indices]
-
-        feature_mean = feature_c.mean(0, keepdim=True)
-        current_sum = torch.zeros_like(feature_mean)
-
-        cur_indices = []
-        for k in range(args.ipc):
-            target = (k + 1) * feature_mean - current_sum
-            dist = torch.norm(target - feature_c, dim=1)
-            indices_sorted = torch.argsort(dist, descending=descending)
-
-            # We can make this faster by reducing feature matrix
-            for idx in indices_sorted:
-                idx = idx.item()
-                if idx not in cur_indices:
-                    cur_indices.append(idx)
-                    break
-            current_sum += feature_c[idx]
+def herding_select(args,
+                   features,
+                   targets,
+                   descending=False,
+                   chunk_size=2**26,
+                   device='cuda',
+                   mem_ratio=0.5):
+    """Herding for all classes at once.
+       Class members are gathered into a padded (nclass x max class size) index matrix and
+       each step picks the argmin distance with already selected (and padded) items masked out.
+       Distances are evaluated in chunks of about chunk_size elements.
+       Features may be on CPU (e.g., memory-mapped). Features of the selected classes are moved to
+       the device once when they fit in mem_ratio of the free memory, otherwise chunks are streamed.
+    """
+    nclass = args.nclass
+    targets = targets.to(device)
+    keep = targets < nclass
+    indices_full = torch.nonzero(keep).squeeze(1)
+    targets = targets[keep]
+
+    # Padded matrix of class members (indices of the kept features)
+    counts = torch.bincount(targets, minlength=nclass)
+    order = torch.argsort(targets, stable=True)
+    offsets = torch.cumsum(counts, 0) - counts
+    pos = torch.arange(len(targets), device=device) - offsets[targets[order]]
+    n_max = counts.max().item()
+    members = torch.zeros(nclass, n_max, dtype=torch.long, device=device)
+    members[targets[order], pos] = order
+    valid = torch.arange(n_max, device=device).unsqueeze(0) < counts.unsqueeze(1)
+
+    n_dim = features.size(1)
+    resident = torch.device(device).type == features.device.type
+    if not resident and torch.device(device).type == 'cuda':
+        size = len(indices_full) * n_dim * features.element_size()
+        resident = size < mem_ratio * torch.cuda.mem_get_info(device)[0]
+    if resident:
+        features = features[indices_full.to(features.device)].to(device)
+        lookup = lambda idx: features[idx]
+    else:
+        indices_src = indices_full.to(features.device)
+        lookup = lambda idx: features[indices_src[idx.to(features.device)]].to(device)
+
+    rows = max(1, chunk_size // n_dim)
+    feature_mean = torch.zeros(nclass, n_dim, dtype=features.dtype, device=device)
+    for i in range(0, len(targets), rows):
+        idx = torch.arange(i, min(i + rows, len(targets)), device=device)
+        feature_mean.index_add_(0, targets[idx], lookup(idx))
+    feature_mean /= counts.clamp(min=1).unsqueeze(1).to(features.dtype)
+    current_sum = torch.zeros_like(feature_mean)
+
+    fill = -float('inf') if descending else float('inf')
+    chunk = max(1, chunk_size // (nclass * n_dim))
+    available = valid.clone()
+    selected = []
+    for k in range(min(args.ipc, n_max)):
+        target = (k + 1) * feature_mean - current_sum
+        dist = torch.empty(nclass, n_max, dtype=features.dtype, device=device)
+        for i in range(0, n_max, chunk):
+            feature_chunk = lookup(members[:, i:i + chunk])
+            dist[:, i:i + chunk] = torch.norm(target.unsqueeze(1) - feature_chunk, dim=2)
+        dist.masked_fill_(~available, fill)
+
+        if descending:
+            idx = torch.argmax(dist, dim=1)
+        else:
+            idx = torch.argmin(dist, dim=1)
+        available[torch.arange(nclass, device=device), idx] = False
+        current_sum += lookup(members.gather(1, idx.unsqueeze(1)).squeeze(1))
+        selected.append(idx)
 
-        indices_slct.append(indices_c[cur_indices])
+    selected = torch.stack(selected, dim=1)
+    selected = indices_full[members.gather(1, selected)].cpu()
+    counts = counts.cpu()
+    indices_slct = [selected[c, :min(args.ipc, counts[c])] for c in range(nclass)]
 
     return indices_slct
 
@@ -170,13 +247,17 @@ def resol(args, img, target, max_size=-1):
 
 
 def herding(args):
-    train_dataset, val_dataset, loader, model = load_pretrained_herding(args)
+    train_dataset, val_dataset, loader, model, file_dir = load_pretrained_herding(args)
     if args.dataset == 'imagenet':
         f_idx = 5
     else:
         f_idx = 2
 
-    features, targets = get_features(model, f_idx, loader)
+    # Features are reused across herding runs (e.g., different ipc)
+    key = f'{utils.hash_file(file_dir)}_{f_idx}_{dataset_key(train_dataset)}'
+    key = f'{args.dataset}_' + hashlib.sha1(key.encode()).hexdigest()
+    features, targets = get_features(model, f_idx, loader, cache_key=key)
+    # Memory-mapped features are moved to GPUs once (or in chunks when they do not fit)
     indices_slct = herding_select(args, features, targets)
 
     # Select and make dataset
@@ -210,7 +291,8 @@ def herding(args):
     else:
         train_transform = None
 
-    train_dataset = TensorDataset(data, target, train_transform)
+    # Herding selects images preprocessed by the (normalizing) test transform
+    train_dataset = TensorDataset(data, target, train_transform, normalized=True)
 
     save_img('./results/herding.png',
              torch.stack([d[0] for d in train_dataset]),
@@ -223,7 +305,7 @@ if __name__ == '__main__':
     from argument import args
     from test import validate
 
-    train_dataset, val_dataset, loader, model = load_pretrained_herding(args)
+    train_dataset, val_dataset, loader, model, _ = load_pretrained_herding(args)
     val_loader = MultiEpochsDataLoader(val_dataset,
                                        batch_size=args.batch_size // 2,
                                        shuffle=False,
@@ -4,8 +4,15 @@ import torchvision.datasets as datasets
 from torchvision.utils import save_image
 import torch.nn.functional as F
 import os
+import copy
+import pickle
+import hashlib
+import threading
 import numpy as np
 import warnings
+from math import ceil
+from collections import deque
+from functools import lru_cache
 from misc import utils
 
 warnings.filterwarnings("ignore")
@@ -26,6 +33,56 @@ MEANS['fashion'] = [0.2861]
 STDS['fashion'] = [0.3530]
 MEANS['tiny'] = [0.485, 0.456, 0.406]
 STDS['tiny'] = [0.229, 0.224, 0.225]
+INDEX_DIR = './results/index'
+_FOLDER_INDEX = {}
+
+
+def load_folder_index(root, extensions=IMG_EXTENSIONS, index_dir=INDEX_DIR):
+    """Load the class folders and image files under root (cached on memory and disk).
+       The index is keyed by the root path and its mtime, so adding or removing a class folder
+       rebuilds it. Remove the index file after modifying images inside class folders.
+    """
+    root = os.path.abspath(os.path.expanduser(root))
+    key = (root, os.stat(root).st_mtime_ns, tuple(extensions))
+    if key in _FOLDER_INDEX:
+        return _FOLDER_INDEX[key]
+
+    tag = hashlib.md5(str(key).encode()).hexdigest()
+    path = os.path.join(index_dir, f'{os.path.basename(root)}_{tag}.pkl')
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+    else:
+        print(f"Build file index of {root}..")
+        classes = sorted(entry.name for entry in os.scandir(root) if entry.is_dir())
+        files = {}
+        for c in classes:
+            files[c] = []
+            for dirpath, _, fnames in sorted(os.walk(os.path.join(root, c), followlinks=True)):
+                for fname in sorted(fnames):
+                    if datasets.folder.has_file_allowed_extension(fname, extensions):
+                        path_rel = os.path.relpath(os.path.join(dirpath, fname), root)
+                        files[c].append(path_rel)
+        index = {'classes': classes, 'files': files}
+
+        os.makedirs(index_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        print(f"File index saved! {path}")
+
+    _FOLDER_INDEX[key] = index
+    return index
+
+
+@lru_cache(maxsize=None)
+def read_class_list(path='./misc/class100.txt'):
+    """Class folder names used for the default ImageNet subclasses
+    """
+    with open(path, 'r') as f:
+        return tuple(c.split('\n')[0] for c in f.readlines())
+
+
 class Data:
     def __init__(self, X_train, Y_train):
         self.X_train = X_train
@@ -57,11 +114,12 @@ class Dataset(torch.utils.data.Dataset):
     
 
 class TensorDataset(torch.utils.data.Dataset):
-    def __init__(self, images, labels, transform=None):
-        # images: NxCxHxW tensor
+    def __init__(self, images, labels, transform=None, normalized=False):
+        # images: NxCxHxW tensor (normalized: images are stored as normalized values)
         self.images = images.detach().cpu().float()
         self.targets = labels.detach().cpu()
         self.transform = transform
+        self.normalized = normalized
 
     def __getitem__(self, index):
         sample = self.images[index]
@@ -90,23 +148,38 @@ class ImageFolder(datasets.DatasetFolder):
                  ipc=-1,
                  seed=-1):
         self.extensions = IMG_EXTENSIONS if is_valid_file is None else None
-        super(ImageFolder, self).__init__(root,
-                                          loader,
-                                          self.extensions,
-                                          transform=transform,
-                                          target_transform=target_transform,
-                                          is_valid_file=is_valid_file)
+        if is_valid_file is None:
+            # Skip the directory walk of DatasetFolder and use the cached file index
+            datasets.VisionDataset.__init__(self,
+                                            root,
+                                            transform=transform,
+                                            target_transform=target_transform)
+            self.loader = loader
+            self.index = load_folder_index(self.root, self.extensions)
+            self.classes = list(self.index['classes'])
+            self.class_to_idx = {cls_name: i for i, cls_name in enumerate(self.classes)}
+        else:
+            self.index = None
+            super(ImageFolder, self).__init__(root,
+                                              loader,
+                                              self.extensions,
+                                              transform=transform,
+                                              target_transform=target_transform,
+                                              is_valid_file=is_valid_file)
 
         # Override
         if nclass < 1000:
             self.classes, self.class_to_idx = self.find_subclasses(nclass=nclass,
                                                                    phase=phase,
                                                                    seed=seed)
-        else:
+        elif self.index is None:
             self.classes, self.class_to_idx = self.find_classes(self.root)
         self.nclass = nclass
-        self.samples = datasets.folder.make_dataset(self.root, self.class_to_idx, self.extensions,
-                                                    is_valid_file)
+        if self.index is not None:
+            self.samples = self._make_dataset_index()
+        else:
+            self.samples = datasets.folder.make_dataset(self.root, self.class_to_idx,
+                                                        self.extensions, is_valid_file)
 
         if ipc > 0:
             self.samples = self._subset(slct_type=slct_type, ipc=ipc)
@@ -127,12 +200,7 @@ class ImageFolder(datasets.DatasetFolder):
         cls_from = nclass * phase
         cls_to = nclass * (phase + 1)
         if seed == 0:
-            with open('./misc/class100.txt', 'r') as f:
-                class_name = f.readlines()
-            for c in class_name:
-                c = c.split('\n')[0]
-                classes.append(c)
-            classes = classes[cls_from:cls_to]
+            classes = list(read_class_list()[cls_from:cls_to])
         else:
             np.random.seed(seed)
             class_indices = np.random.permutation(len(self.classes))[cls_from:cls_to]
@@ -144,6 +212,17 @@ class ImageFolder(datasets.DatasetFolder):
 
         return classes, class_to_idx
 
+    def _make_dataset_index(self):
+        """Same samples as datasets.folder.make_dataset, but built from the file index
+        """
+        samples = []
+        for cls_name in sorted(self.class_to_idx.keys()):
+            idx = self.class_to_idx[cls_name]
+            for path_rel in self.index['files'][cls_name]:
+                samples.append((os.path.join(self.root, path_rel), idx))
+
+        return samples
+
     def _subset(self, slct_type='random', ipc=10):
         n = len(self.samples)
         idx_class = [[] for _ in range(self.nclass)]
@@ -208,7 +287,10 @@ def transform_cifar(augment=False, from_tensor=False, normalize=True):
     if not augment:
         aug = []
     else:
-        aug = [transforms.RandomCrop(32, padding=4), transforms.RandomHorizontalFlip()]
+        if from_tensor:
+            aug = [utils.BatchRandomCrop(32, padding=4), utils.BatchRandomHorizontalFlip()]
+        else:
+            aug = [transforms.RandomCrop(32, padding=4), transforms.RandomHorizontalFlip()]
         print("Dataset with basic Cifar augmentation")
 
     if from_tensor:
@@ -231,7 +313,10 @@ def transform_svhn(augment=False, from_tensor=False, normalize=True):
     if not augment:
         aug = []
     else:
-        aug = [transforms.RandomCrop(32, padding=4)]
+        if from_tensor:
+            aug = [utils.BatchRandomCrop(32, padding=4)]
+        else:
+            aug = [transforms.RandomCrop(32, padding=4)]
         print("Dataset with basic SVHN augmentation")
 
     if from_tensor:
@@ -254,7 +339,10 @@ def transform_mnist(augment=False, from_tensor=False, normalize=True):
     if not augment:
         aug = []
     else:
-        aug = [transforms.RandomCrop(28, padding=4)]
+        if from_tensor:
+            aug = [utils.BatchRandomCrop(28, padding=4)]
+        else:
+            aug = [transforms.RandomCrop(28, padding=4)]
         print("Dataset with basic MNIST augmentation")
 
     if from_tensor:
@@ -277,7 +365,10 @@ def transform_fashion(augment=False, from_tensor=False, normalize=True):
     if not augment:
         aug = []
     else:
-        aug = [transforms.RandomCrop(28, padding=4)]
+        if from_tensor:
+            aug = [utils.BatchRandomCrop(28, padding=4)]
+        else:
+            aug = [transforms.RandomCrop(28, padding=4)]
         print("Dataset with basic FashionMNIST augmentation")
 
     if from_tensor:
@@ -298,7 +389,10 @@ def transform_tiny(augment=False, from_tensor=False, normalize=True):
     if not augment:
         aug = []
     else:
-        aug = [transforms.RandomCrop(64, padding=4), transforms.RandomHorizontalFlip()]
+        if from_tensor:
+            aug = [utils.BatchRandomCrop(64, padding=4), utils.BatchRandomHorizontalFlip()]
+        else:
+            aug = [transforms.RandomCrop(64, padding=4), transforms.RandomHorizontalFlip()]
         print("Dataset with basic tiny augmentation")
 
     if from_tensor:
@@ -331,27 +425,39 @@ def transform_imagenet(size=-1,
         resize_test = []
         assert rrc_size > 0, "Set RRC size!"
     else:
-        resize_train = [transforms.RandomResizedCrop(224)]
+        if from_tensor:
+            resize_train = [utils.BatchRandomResizedCrop(224)]
+        else:
+            resize_train = [transforms.RandomResizedCrop(224)]
         resize_test = [transforms.Resize(256), transforms.CenterCrop(224)]
 
     if not augment:
         aug = []
         # print("Loader with DSA augmentation")
     else:
-        jittering = utils.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4)
-        lighting = utils.Lighting(alphastd=0.1,
-                                  eigval=[0.2175, 0.0188, 0.0045],
-                                  eigvec=[
-                                      [-0.5675, 0.7192, 0.4009],
-                                      [-0.5808, -0.0045, -0.8140],
-                                      [-0.5836, -0.6948, 0.4203],
-                                  ])
-        aug = [transforms.RandomHorizontalFlip(), jittering, lighting]
+        eigval = [0.2175, 0.0188, 0.0045]
+        eigvec = [
+            [-0.5675, 0.7192, 0.4009],
+            [-0.5808, -0.0045, -0.8140],
+            [-0.5836, -0.6948, 0.4203],
+        ]
+        if from_tensor:
+            # Batched versions (per-sample parameters) for condensed data on GPUs
+            jittering = utils.BatchColorJitter(brightness=0.4, contrast=0.4, saturation=0.4)
+            lighting = utils.BatchLighting(alphastd=0.1, eigval=eigval, eigvec=eigvec)
+            aug = [utils.BatchRandomHorizontalFlip(), jittering, lighting]
+        else:
+            jittering = utils.ColorJitter(brightness=0.4, contrast=0.4, saturation=0.4)
+            lighting = utils.Lighting(alphastd=0.1, eigval=eigval, eigvec=eigvec)
+            aug = [transforms.RandomHorizontalFlip(), jittering, lighting]
 
         if rrc and size >= 0:
             if rrc_size == -1:
                 rrc_size = size
-            rrc_fn = transforms.RandomResizedCrop(rrc_size, scale=(0.5, 1.0))
+            if from_tensor:
+                rrc_fn = utils.BatchRandomResizedCrop(rrc_size, scale=(0.5, 1.0))
+            else:
+                rrc_fn = transforms.RandomResizedCrop(rrc_size, scale=(0.5, 1.0))
             aug = [rrc_fn] + aug
             print("Dataset with basic imagenet augmentation and RRC")
         else:
@@ -411,13 +517,110 @@ class ClassBatchSampler(object):
         return len(self.samplers)
 
 
+class TensorBatchSampler(object):
+    """Infinite random batch sampler over an index tensor.
+       Permutations are drawn on the device of the indices and batches are sliced from them.
+    """
+    def __init__(self, indices, batch_size, drop_last=True):
+        self.indices = indices
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.perm = None
+        self.loc = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        n = len(self.indices)
+        if (self.perm is None) or (self.loc >= n) or (self.drop_last and
+                                                      self.loc + self.batch_size > n):
+            self.perm = self.indices[torch.randperm(n, device=self.indices.device)]
+            self.loc = 0
+
+        batch = self.perm[self.loc:self.loc + self.batch_size]
+        self.loc += self.batch_size
+        return batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        else:
+            return ceil(len(self.indices) / self.batch_size)
+
+
+class ClassTensorBatchSampler(object):
+    """Intra-class batch sampler on index tensors
+    """
+    def __init__(self, cls_idx, batch_size, drop_last=True):
+        self.samplers = []
+        for indices in cls_idx:
+            n_ex = len(indices)
+            self.samplers.append(
+                TensorBatchSampler(indices, batch_size=min(n_ex, batch_size), drop_last=drop_last))
+
+    def __iter__(self):
+        while True:
+            for sampler in self.samplers:
+                yield next(sampler)
+
+    def __len__(self):
+        return len(self.samplers)
+
+
+class DemandBatchSampler(object):
+    """Batch sampler of a worker pool shared by random batches and class batches.
+       Batches are drawn for the kind the loader waits for (want: -1 for random batches, c for class c).
+       Class batches are issued round-robin over the classes with less than prefetch pending batches.
+       Kinds of the issued batches are recorded in order, as workers return batches in that order.
+    """
+    def __init__(self, batch_sampler, class_sampler, prefetch=2):
+        self.batch_sampler = batch_sampler
+        self.random = iter(_RepeatSampler(batch_sampler))
+        self.classes = class_sampler.samplers
+        self.nclass = len(self.classes)
+        self.prefetch = prefetch
+
+        self.want = -1
+        self.class_next = 0
+        self.pending = [0] * self.nclass  # queued or in-flight batches per class
+        self.kinds = deque()
+
+    def _next_class(self):
+        c = self.want
+        if self.pending[c] > 0:
+            for i in range(self.nclass):
+                c_i = (self.class_next + i) % self.nclass
+                if self.pending[c_i] < self.prefetch:
+                    c = c_i
+                    break
+        self.class_next = (c + 1) % self.nclass
+        return c
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.want < 0:
+            self.kinds.append(-1)
+            return next(self.random)
+
+        c = self._next_class()
+        self.kinds.append(c)
+        self.pending[c] += 1
+        return next(self.classes[c])
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
 class MultiEpochsDataLoader(torch.utils.data.DataLoader):
     """Multi epochs data loader
     """
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._DataLoader__initialized = False
-        self.batch_sampler = _RepeatSampler(self.batch_sampler)
+        self.batch_sampler = self._repeat_sampler(self.batch_sampler)
         self._DataLoader__initialized = True
         self.iterator = super().__iter__()  # Init iterator and sampler once
 
@@ -430,6 +633,9 @@ class MultiEpochsDataLoader(torch.utils.data.DataLoader):
         else:
             self.device = 'cuda'
 
+    def _repeat_sampler(self, batch_sampler):
+        return _RepeatSampler(batch_sampler)
+
     def __len__(self):
         return len(self.batch_sampler)
 
@@ -442,38 +648,62 @@ class MultiEpochsDataLoader(torch.utils.data.DataLoader):
 
 
 class ClassDataLoader(MultiEpochsDataLoader):
-    """Basic class loader (might be slow for processing data)
+    """Basic class loader. Random batches and class batches are loaded by the same worker processes
+       (see DemandBatchSampler), and batches of the other kinds wait in per-kind queues.
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, prefetch=2, **kwargs):
+        self.prefetch = prefetch
         super().__init__(*args, **kwargs)
 
-        self.nclass = self.dataset.nclass
-        self.cls_idx = [[] for _ in range(self.nclass)]
-        for i in range(len(self.dataset)):
-            self.cls_idx[self.dataset.targets[i]].append(i)
-        self.class_sampler = ClassBatchSampler(self.cls_idx, self.batch_size, drop_last=True)
-
+        self.queue = {c: deque() for c in range(-1, self.nclass)}
         self.cls_targets = torch.tensor([np.ones(self.batch_size) * c for c in range(self.nclass)],
                                         dtype=torch.long,
                                         requires_grad=False,
                                         device='cuda')
 
+    def _repeat_sampler(self, batch_sampler):
+        self.nclass = self.dataset.nclass
+        targets = np.array(self.dataset.targets)
+        self.cls_idx = [np.nonzero(targets == c)[0].tolist() for c in range(self.nclass)]
+        self.class_sampler = ClassBatchSampler(self.cls_idx, self.batch_size, drop_last=True)
+        return DemandBatchSampler(batch_sampler, self.class_sampler, prefetch=self.prefetch)
+
+    def _next(self, kind):
+        """Next batch of the kind (-1: random batch, c: batch of class c).
+           Batches of the other kinds returned in the meantime are queued.
+        """
+        sampler = self.batch_sampler
+        sampler.want = kind
+        while len(self.queue[kind]) == 0:
+            batch = next(self.iterator)
+            self.queue[sampler.kinds.popleft()].append(batch)
+        if kind >= 0:
+            sampler.pending[kind] -= 1
+        return self.queue[kind].popleft()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            data, target = self._next(-1)
+            if self.convert != None:
+                data = self.convert(data)
+            yield data, target
+
     def class_sample(self, c, ipc=-1):
         if ipc > 0:
             indices = self.cls_idx[c][:ipc]
+            data = torch.stack([self.dataset[i][0] for i in indices])
+            target = torch.tensor([self.dataset.targets[i] for i in indices])
         else:
-            indices = next(self.class_sampler.samplers[c])
+            data, target = self._next(c)
 
-        data = torch.stack([self.dataset[i][0] for i in indices])
-        target = torch.tensor([self.dataset.targets[i] for i in indices])
-        return data.cuda(), target.cuda()
+        return data.cuda(non_blocking=True), target.cuda(non_blocking=True)
 
     def sample(self):
-        data, target = next(self.iterator)
+        data, target = self._next(-1)
         if self.convert != None:
             data = self.convert(data)
 
-        return data.cuda(), target.cuda()
+        return data.cuda(non_blocking=True), target.cuda(non_blocking=True)
 
 
 class ClassMemDataLoader():
@@ -484,27 +714,29 @@ class ClassMemDataLoader():
         self.batch_size = batch_size
 
         self.dataset = dataset
-        self.data = [d[0].to(device) for d in dataset]  # uint8 data
+        self.data = None  # uint8 data (contiguous N x C x H x W)
+        for i in range(len(dataset)):
+            img = dataset[i][0]
+            if self.data is None:
+                self.data = torch.empty((len(dataset), *img.shape), dtype=img.dtype, device=device)
+            self.data[i].copy_(img)
         self.targets = torch.tensor(dataset.targets, dtype=torch.long, device=device)
 
-        sampler = torch.utils.data.SubsetRandomSampler([i for i in range(len(dataset))])
-        self.batch_sampler = torch.utils.data.BatchSampler(sampler,
-                                                           batch_size=batch_size,
-                                                           drop_last=drop_last)
-        self.iterator = iter(_RepeatSampler(self.batch_sampler))
+        self.batch_sampler = TensorBatchSampler(torch.arange(len(dataset), device=device),
+                                                batch_size=batch_size,
+                                                drop_last=drop_last)
+        self.iterator = self.batch_sampler
 
         self.nclass = dataset.nclass
-        self.cls_idx = [[] for _ in range(self.nclass)]
-        for i in range(len(dataset)):
-            self.cls_idx[self.targets[i]].append(i)
-        self.class_sampler = ClassBatchSampler(self.cls_idx, self.batch_size, drop_last=True)
+        self.cls_idx = [torch.nonzero(self.targets == c).squeeze(1) for c in range(self.nclass)]
+        self.class_sampler = ClassTensorBatchSampler(self.cls_idx, self.batch_size, drop_last=True)
         self.cls_targets = torch.tensor([np.ones(batch_size) * c for c in range(self.nclass)],
                                         dtype=torch.long,
                                         requires_grad=False,
                                         device=self.device)
 
         self.convert = None
-        if self.data[0].dtype == torch.uint8:
+        if self.data.dtype == torch.uint8:
             self.convert = transforms.ConvertImageDtype(torch.float)
 
     def class_sample(self, c, ipc=-1):
@@ -513,20 +745,18 @@ class ClassMemDataLoader():
         else:
             indices = next(self.class_sampler.samplers[c])
 
-        data = torch.stack([self.data[i] for i in indices])
-        # print("self.convert:",self.convert)
+        data = self.data.index_select(0, indices)
         if self.convert != None:
             data = self.convert(data)
 
-        # print(self.targets[indices])
         return data, self.cls_targets[c]
 
     def sample(self):
         indices = next(self.iterator)
-        data = torch.stack([self.data[i] for i in indices])
+        data = self.data.index_select(0, indices)
         if self.convert != None:
             data = self.convert(data)
-        target = self.targets[indices]
+        target = self.targets.index_select(0, indices)
 
         return data, target
 
@@ -539,10 +769,181 @@ class ClassMemDataLoader():
             yield data, target
 
 
+class TensorMemDataLoader():
+    """Loader for small tensor datasets (e.g., condensed data) with data on GPUs.
+       The transform of the dataset is applied to each batch, so it should consist of
+       batched tensor ops (see transform_cifar with from_tensor=True).
+    """
+    def __init__(self, dataset, batch_size, drop_last=False, device='cuda'):
+        self.device = device
+        self.batch_size = batch_size
+
+        self.dataset = dataset
+        self.images = dataset.images.to(device)
+        self.targets = dataset.targets.to(device)
+        self.transform = dataset.transform
+
+        self.batch_sampler = TensorBatchSampler(torch.arange(len(dataset), device=device),
+                                                batch_size=batch_size,
+                                                drop_last=drop_last)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            indices = next(self.batch_sampler)
+            data = self.images.index_select(0, indices)
+            if self.transform != None:
+                data = self.transform(data)
+            yield data, self.targets.index_select(0, indices)
+
+
+class ValMemDataLoader():
+    """Validation loader with the preprocessed data on GPUs.
+       Images are stored as uint8 pixels (normalized at each batch) or as normalized fp16 values.
+    """
+    def __init__(self, val_loader, dataname, batch_size=500, dtype='uint8', device='cuda'):
+        self.device = device
+        self.batch_size = batch_size
+        self.dtype = dtype
+
+        nch = len(MEANS[dataname])
+        self.mean = torch.tensor(MEANS[dataname], device=device).reshape(1, nch, 1, 1)
+        self.std = torch.tensor(STDS[dataname], device=device).reshape(1, nch, 1, 1)
+
+        data = []
+        targets = []
+        for input, target in val_loader:
+            input = input.to(device, non_blocking=True)
+            if dtype == 'uint8':
+                input = (input * self.std + self.mean).mul_(255).round_().clamp_(0, 255)
+                input = input.to(torch.uint8)
+            else:
+                input = input.half()
+            data.append(input)
+            targets.append(target.to(device, non_blocking=True))
+
+        self.data = torch.cat(data)
+        self.targets = torch.cat(targets)
+        print(f"Validation data cached on memory ({dtype}): ", self.data.shape)
+
+    def subset(self, indices):
+        """Loader over the given samples of the cached data
+        """
+        loader = copy.copy(self)
+        indices = torch.as_tensor(indices, device=self.data.device)
+        loader.data = self.data.index_select(0, indices)
+        loader.targets = self.targets.index_select(0, indices)
+        return loader
+
+    def __len__(self):
+        return ceil(len(self.data) / self.batch_size)
+
+    def __iter__(self):
+        for i in range(0, len(self.data), self.batch_size):
+            data = self.data[i:i + self.batch_size]
+            if self.dtype == 'uint8':
+                data = data.float().div_(255).sub_(self.mean).div_(self.std)
+            else:
+                data = data.float()
+            yield data, self.targets[i:i + self.batch_size]
+
+
+def dataset_key(dataset):
+    """Identity of a dataset that is stable across instances: root, split, transform and samples
+    """
+    h = hashlib.sha1()
+    samples = getattr(dataset, 'samples', None)
+    if samples is not None:
+        h.update(repr([path for path, _ in samples]).encode())
+    targets = getattr(dataset, 'targets', getattr(dataset, 'labels', None))
+    if targets is not None:
+        h.update(np.asarray(targets).tobytes())
+    return (type(dataset).__name__, str(getattr(dataset, 'root', None)),
+            getattr(dataset, 'train', getattr(dataset, 'split', None)),
+            repr(getattr(dataset, 'transform', None)), len(dataset), h.hexdigest())
+
+
+# (key, loader) of the most recently cached validation set
+_VAL_CACHE = (None, None)
+
+
+def load_val_cache(val_loader, dataname, batch_size=500, dtype='uint8'):
+    """Cache the validation set on GPUs (shared by all models evaluated on it).
+       Only the most recent validation set is kept.
+    """
+    global _VAL_CACHE
+    if isinstance(val_loader, ValMemDataLoader):
+        return val_loader
+
+    key = (dataset_key(val_loader.dataset), dataname, dtype)
+    if _VAL_CACHE[0] != key:
+        _VAL_CACHE = (None, None)  # Release the previous copy first
+        _VAL_CACHE = (key, ValMemDataLoader(val_loader, dataname, batch_size, dtype=dtype))
+        _VAL_CACHE[1].key = key
+
+    loader = _VAL_CACHE[1]
+    if loader.batch_size != batch_size:
+        loader = copy.copy(loader)
+        loader.batch_size = batch_size
+    return loader
+
+
+def stratified_indices(targets, size, seed=0):
+    """Seeded subset of about size samples with the class proportions of targets
+    """
+    targets = np.asarray(targets)
+    rng = np.random.RandomState(seed)
+    indices = []
+    for c in np.unique(targets):
+        idx_c = np.nonzero(targets == c)[0]
+        n_c = max(1, int(round(size * len(idx_c) / len(targets))))
+        indices.append(rng.permutation(idx_c)[:n_c])
+    return np.sort(np.concatenate(indices))
+
+
+# (key, loader) of the most recent validation subset
+_VAL_SUBSET = (None, None)
+
+
+def load_val_subset(val_loader, size, seed=0):
+    """Loader over a fixed stratified subset of the validation set (only the most recent one is kept).
+       val_loader can be a ValMemDataLoader (see load_val_cache) or a DataLoader.
+    """
+    global _VAL_SUBSET
+    if isinstance(val_loader, ValMemDataLoader):
+        source = val_loader
+        key = (getattr(source, 'key', id(source)), source.batch_size, size, seed)
+    else:
+        source = val_loader.dataset
+        key = (dataset_key(source), val_loader.batch_size, size, seed)
+
+    if _VAL_SUBSET[0] != key:
+        _VAL_SUBSET = (None, None)
+        if isinstance(val_loader, ValMemDataLoader):
+            indices = stratified_indices(val_loader.targets.cpu().numpy(), size, seed=seed)
+            loader = val_loader.subset(indices)
+        else:
+            targets = getattr(source, 'targets', None)
+            if targets is None:
+                targets = source.labels
+            indices = stratified_indices(targets, size, seed=seed)
+            loader = MultiEpochsDataLoader(torch.utils.data.Subset(source, indices),
+                                           batch_size=val_loader.batch_size,
+                                           shuffle=False,
+                                           num_workers=val_loader.num_workers,
+                                           persistent_workers=val_loader.num_workers > 0)
+        _VAL_SUBSET = (key, loader)
+    return _VAL_SUBSET[1]
+
+
 class ClassPartMemDataLoader(MultiEpochsDataLoader):
     """Class loader for ImageNet-100 with multi-processing.
        This loader loads target subclass samples on GPUs
        while can loading full training data from storage. 
+       Target classes are loaded one after another in a background thread, and class_sample
+       of a class only waits until that class is loaded.
     """
     def __init__(self, subclass_list, real_to_idx, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -551,38 +952,87 @@ class ClassPartMemDataLoader(MultiEpochsDataLoader):
         self.mem_cls = subclass_list
         self.real_to_idx = real_to_idx
 
+        # Only decode the files of target subclasses, grouped by class in the order of subclass_list
+        targets = np.array(self.dataset.targets)
+        mem_indices = [np.nonzero(targets == c)[0] for c in self.mem_cls]
+        counts = [len(idx) for idx in mem_indices]
+        ends = np.cumsum(counts)
+        mem_indices = np.concatenate(mem_indices)
+
         self.cls_idx = [[] for _ in range(self.nclass)]
-        idx = 0
-        self.data_mem = []
-        print("Load target class data on memory..")
-        for i in range(len(self.dataset)):
-            c = self.dataset.targets[i]
-            if c in self.mem_cls:
-                self.data_mem.append(self.dataset[i][0].cuda())
-                self.cls_idx[c].append(idx)
-                idx += 1
-
-        if self.data_mem[0].dtype == torch.uint8:
+        self.cls_end = {}
+        self.cls_ready = {}
+        for c, n, end in zip(self.mem_cls, counts, ends):
+            self.cls_end[c] = end
+            self.cls_ready[c] = threading.Event()
+            self.cls_idx[c] = torch.arange(end - n, end, dtype=torch.long, device='cuda')
+
+        sample = self.dataset[mem_indices[0]][0]
+        self.data_mem = torch.empty((len(mem_indices), *sample.shape),
+                                    dtype=sample.dtype,
+                                    device='cuda')
+        if self.data_mem.dtype == torch.uint8:
             self.convert = transforms.ConvertImageDtype(torch.float)
-        print(f"Subclass: {subclass_list}, {len(self.data_mem)}")
+
+        print("Load target class data on memory..")
+        self.load_error = None
+        self.loader_thread = threading.Thread(target=self._load, args=(mem_indices, ), daemon=True)
+        self.loader_thread.start()
+
 
         class_batch_size = 64
-        self.class_sampler = ClassBatchSampler([self.cls_idx[c] for c in subclass_list],
-                                               class_batch_size,
-                                               drop_last=True)
+        self.class_sampler = ClassTensorBatchSampler([self.cls_idx[c] for c in subclass_list],
+                                                     class_batch_size,
+                                                     drop_last=True)
         self.cls_targets = torch.tensor([np.ones(class_batch_size) * c for c in range(self.nclass)],
                                         dtype=torch.long,
                                         requires_grad=False,
                                         device='cuda')
 
+    def _load(self, mem_indices):
+        """Decode the target class images (by loader workers) into data_mem, chunk by chunk.
+           Copies are issued on the default stream, before the class is marked ready.
+        """
+        try:
+            subset = torch.utils.data.Subset(self.dataset, mem_indices.tolist())
+            chunk_loader = torch.utils.data.DataLoader(subset,
+                                                       batch_size=256,
+                                                       shuffle=False,
+                                                       num_workers=self.num_workers,
+                                                       pin_memory=True)
+            pending = list(self.mem_cls)
+            loc = 0
+            for data, _ in chunk_loader:
+                self.data_mem[loc:loc + len(data)].copy_(data, non_blocking=True)
+                loc += len(data)
+                while pending and self.cls_end[pending[0]] <= loc:
+                    self.cls_ready[pending.pop(0)].set()
+            print(f"Subclass: {self.mem_cls}, {len(self.data_mem)} loaded")
+        except Exception as e:
+            self.load_error = e
+        finally:
+            for event in self.cls_ready.values():
+                event.set()
+
+    def wait(self, c=None):
+        """Wait until class c (all target classes if None) is loaded
+        """
+        if c is None:
+            self.loader_thread.join()
+        else:
+            self.cls_ready[c].wait()
+        if self.load_error is not None:
+            raise self.load_error
+
     def class_sample(self, c, ipc=-1):
+        self.wait(c)
         if ipc > 0:
             indices = self.cls_idx[c][:ipc]
         else:
             idx = self.real_to_idx[c]
             indices = next(self.class_sampler.samplers[idx])
 
-        data = torch.stack([self.data_mem[i] for i in indices])
+        data = self.data_mem.index_select(0, indices)
         if self.convert != None:
             data = self.convert(data)
 
@@ -594,7 +1044,7 @@ class ClassPartMemDataLoader(MultiEpochsDataLoader):
         if self.convert != None:
             data = self.convert(data)
 
-        return data.cuda(), target.cuda()
+        return data.cuda(non_blocking=True), target.cuda(non_blocking=True)
 
 
 def load_data(args):
@@ -9,7 +9,8 @@ class DiffAug():
                  strategy='color_crop_cutout_flip_scale_rotate',
                  batch=False,
                  ratio_cutout=0.5,
-                 single=False):
+                 single=False,
+                 fused=False):
         self.prob_flip = 0.5
         self.ratio_scale = 1.2
         self.ratio_rotate = 15.0
@@ -21,6 +22,12 @@ class DiffAug():
         self.contrast = 0.5
 
         self.batch = batch
+        self.fused = fused
+        self.seed = -1
+        self.generators = {}
+        self.grids = {}
+        self.stream = None
+        self.params = None
 
         self.aug = True
         if strategy == '' or strategy.lower() == 'none':
@@ -49,10 +56,21 @@ class DiffAug():
             'rotate': [self.rotate_fn],
             'translate': [self.translate_fn],
         }
+        # Geometric transforms as homogeneous affine matrices (for the fused mode)
+        self.theta_fn = {
+            'crop': self.crop_theta,
+            'flip': self.flip_theta,
+            'scale': self.scale_theta,
+            'rotate': self.rotate_theta,
+            'translate': self.translate_theta,
+        }
 
-    def __call__(self, x, single_aug=True, seed=-1):
+    def __call__(self, x, single_aug=True, seed=-1, step=-1):
         if not self.aug:
             return x
+        self.load_params(step)
+        if self.fused:
+            return self.fused_call(x, single_aug=single_aug, seed=seed)
         else:
             if self.flip:
                 self.set_seed(seed)
@@ -64,8 +82,7 @@ class DiffAug():
             if len(self.strategy) > 0:
                 if single_aug:
                     # single
-                    idx = np.random.randint(len(self.strategy))
-                    p = self.strategy[idx]
+                    p = self.choose()
                     for f in self.aug_fn[p]:
                         self.set_seed(seed)
                         x = f(x, self.batch)
@@ -82,27 +99,229 @@ class DiffAug():
             x = x.contiguous()
             return x
 
+    def fused_call(self, x, single_aug=True, seed=-1):
+        """Compose the chosen geometric transforms into one affine matrix and resample once.
+           Color ops are applied before the resampling and cutout as a mask after it.
+        """
+        if len(self.strategy) > 0:
+            if single_aug:
+                strategy = [self.choose()]
+            else:
+                strategy = self.strategy
+        else:
+            strategy = []
+        if self.flip:
+            strategy = ['flip'] + strategy
+
+        n = 1 if self.batch else x.size(0)
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(n, 1, 1)
+        geometric = False
+        masked = self.cutout
+        if self.color:
+            for f in self.aug_fn['color']:
+                self.set_seed(seed)
+                x = f(x, self.batch)
+        for p in strategy:
+            self.set_seed(seed)
+            if p in self.theta_fn:
+                # Applying A then B samples the input at A @ B @ grid
+                theta = theta @ self.theta_fn[p](x, self.batch)
+                geometric = True
+            elif p == 'cutout':
+                masked = True
+            else:
+                for f in self.aug_fn[p]:
+                    x = f(x, self.batch)
+
+        if geometric:
+            grid = F.affine_grid(theta[:, :2].expand(x.shape[0], 2, 3), x.shape)
+            x = F.grid_sample(x, grid)
+        if masked:
+            self.set_seed(seed)
+            x = x * self.cutout_mask(x, self.batch)
+
+        x = x.contiguous()
+        return x
+
+    def flip_theta(self, x, batch=True):
+        randf = self.rand(x, batch)
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(len(randf), 1, 1)
+        theta[:, 0, 0] = torch.where(randf < self.prob_flip, -1., 1.).to(x.dtype)
+        return theta
+
+    def scale_theta(self, x, batch=True):
+        ratio = self.ratio_scale
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(1 if batch else x.size(0), 1, 1)
+        theta[:, 0, 0] = self.rand(x, batch) * (ratio - 1.0 / ratio) + 1.0 / ratio
+        theta[:, 1, 1] = self.rand(x, batch) * (ratio - 1.0 / ratio) + 1.0 / ratio
+        return theta
+
+    def rotate_theta(self, x, batch=True):
+        ratio = self.ratio_rotate
+        angle = (self.rand(x, batch) - 0.5) * 2 * ratio / 180 * float(np.pi)
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(len(angle), 1, 1)
+        theta[:, 0, 0] = torch.cos(angle)
+        theta[:, 0, 1] = -torch.sin(angle)
+        theta[:, 1, 0] = torch.sin(angle)
+        theta[:, 1, 1] = torch.cos(angle)
+        return theta
+
+    def crop_theta(self, x, batch=True):
+        # Integer pixel shifts with zero padding (same as crop_fn)
+        ratio = self.ratio_crop_pad
+        shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+        translation_x = self.randint(x, batch, -shift_x, shift_x + 1)
+        translation_y = self.randint(x, batch, -shift_y, shift_y + 1)
+
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(len(translation_x), 1, 1)
+        theta[:, 0, 2] = 2 * translation_y.to(x.dtype) / x.size(3)
+        theta[:, 1, 2] = 2 * translation_x.to(x.dtype) / x.size(2)
+        return theta
+
+    def translate_theta(self, x, batch=True):
+        ratio = self.ratio_crop_pad
+        shift_y = int(x.size(3) * ratio + 0.5)
+        translation_y = self.randint(x, batch, -shift_y, shift_y + 1)
+
+        theta = torch.eye(3, dtype=x.dtype, device=x.device).repeat(len(translation_y), 1, 1)
+        theta[:, 0, 2] = 2 * translation_y.to(x.dtype) / x.size(3)
+        return theta
+
+    def cutout_mask(self, x, batch=True):
+        """Cutout mask (N x 1 x H x W) from broadcasted comparisons
+        """
+        ratio = self.ratio_cutout
+        cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
+        offset_x = self.randint(x, batch, 0, x.size(2) + (1 - cutout_size[0] % 2), 1, 1)
+        offset_y = self.randint(x, batch, 0, x.size(3) + (1 - cutout_size[1] % 2), 1, 1)
+
+        cut = self.box(x, offset_x - cutout_size[0] // 2, offset_y - cutout_size[1] // 2,
+                       cutout_size)
+        return (~cut).unsqueeze(1).to(x.dtype)
+
+    def grid(self, x):
+        """Batch, row and column index tensors shaped for broadcasting (cached per input shape)
+        """
+        key = (x.size(0), x.size(2), x.size(3), x.device, x.dtype)
+        if key not in self.grids:
+            self.grids[key] = (
+                torch.arange(x.size(0), dtype=torch.long, device=x.device).reshape(-1, 1, 1),
+                torch.arange(x.size(2), dtype=torch.long, device=x.device).reshape(1, -1, 1),
+                torch.arange(x.size(3), dtype=torch.long, device=x.device).reshape(1, 1, -1),
+            )
+        return self.grids[key]
+
+    def box(self, x, lo_x, lo_y, size):
+        """Boolean N x H x W mask of the boxes [lo_x, lo_x + size[0]) x [lo_y, lo_y + size[1])
+        """
+        _, rows, cols = self.grid(x)
+        rows = rows - lo_x
+        cols = cols - lo_y
+        return (rows >= 0) & (rows < size[0]) & (cols >= 0) & (cols < size[1])
+
     def set_seed(self, seed):
         if seed > 0:
             np.random.seed(seed)
             torch.random.manual_seed(seed)
+            self.seed = seed
+            self.generators = {}
+
+    def set_stream(self, seed, block=1000, device='cuda', n_param=16):
+        """Pre-generate siamese augmentation parameters in blocks of steps.
+           Calls with step >= 0 consume the parameters of that step, so the same step index
+           gives identical augmentations (e.g., for real and synthetic halves or resumed runs).
+        """
+        self.stream = {
+            'seed': seed,
+            'block': block,
+            'device': torch.device(device),
+            'n_param': n_param,
+            'index': -1,
+        }
+
+    def load_params(self, step):
+        self.params = None
+        if self.stream is None or step < 0 or not self.batch:
+            return
+
+        stream = self.stream
+        index = step // stream['block']
+        if index != stream['index']:
+            # Each block only depends on (seed, block index)
+            state = np.random.SeedSequence([stream['seed'], index]).generate_state(2)
+            gen = torch.Generator(device=stream['device'])
+            gen.manual_seed(int(state[0]))
+            stream['params'] = torch.rand(stream['block'],
+                                          stream['n_param'],
+                                          device=stream['device'],
+                                          generator=gen)
+            rng = np.random.RandomState(state[1])
+            stream['choice'] = rng.randint(max(len(self.strategy), 1), size=stream['block'])
+            stream['index'] = index
+
+        self.params = stream['params'][step % stream['block']]
+        self.choice = stream['choice'][step % stream['block']]
+        self.slot = 0
+
+    def next_param(self, x):
+        if self.slot >= len(self.params):
+            raise ValueError(f"Augmentation stream has only {len(self.params)} parameters per step")
+        u = self.params[self.slot].to(device=x.device, dtype=x.dtype)
+        self.slot += 1
+        return u
+
+    def choose(self):
+        if self.params is not None:
+            return self.strategy[self.choice]
+        return self.strategy[np.random.randint(len(self.strategy))]
+
+    def generator(self, device):
+        """Random generator on the device of the data (seeded from the global RNG by default)
+        """
+        device = torch.device(device)
+        if device not in self.generators:
+            gen = torch.Generator(device=device)
+            if self.seed > 0:
+                gen.manual_seed(self.seed)
+            else:
+                gen.manual_seed(torch.randint(2**62, size=[1]).item())
+            self.generators[device] = gen
+        return self.generators[device]
+
+    def rand(self, x, batch, *shape):
+        """Uniform [0, 1) parameters, shared by the batch (siamese) or drawn per sample
+        """
+        n = 1 if batch else x.size(0)
+        if batch and self.params is not None:
+            return self.next_param(x).reshape(1, *shape)
+        return torch.rand(n,
+                          *shape,
+                          dtype=x.dtype,
+                          device=x.device,
+                          generator=self.generator(x.device))
+
+    def randint(self, x, batch, low, high, *shape):
+        n = 1 if batch else x.size(0)
+        if batch and self.params is not None:
+            u = self.next_param(x).float()
+            return (low + (u * (high - low)).long()).reshape(1, *shape)
+        return torch.randint(low,
+                             high,
+                             size=[n, *shape],
+                             device=x.device,
+                             generator=self.generator(x.device))
 
     def scale_fn(self, x, batch=True):
         # x>1, max scale
         # sx, sy: (0, +oo), 1: orignial size, 0.5: enlarge 2 times
         ratio = self.ratio_scale
 
-        if batch:
-            sx = np.random.uniform() * (ratio - 1.0 / ratio) + 1.0 / ratio
-            sy = np.random.uniform() * (ratio - 1.0 / ratio) + 1.0 / ratio
-            theta = [[sx, 0, 0], [0, sy, 0]]
-            theta = torch.tensor(theta, dtype=torch.float, device=x.device)
-            theta = theta.expand(x.shape[0], 2, 3)
-        else:
-            sx = np.random.uniform(size=x.shape[0]) * (ratio - 1.0 / ratio) + 1.0 / ratio
-            sy = np.random.uniform(size=x.shape[0]) * (ratio - 1.0 / ratio) + 1.0 / ratio
-            theta = [[[sx[i], 0, 0], [0, sy[i], 0]] for i in range(x.shape[0])]
-            theta = torch.tensor(theta, dtype=torch.float, device=x.device)
+        sx = self.rand(x, batch) * (ratio - 1.0 / ratio) + 1.0 / ratio
+        sy = self.rand(x, batch) * (ratio - 1.0 / ratio) + 1.0 / ratio
+        theta = torch.zeros(len(sx), 2, 3, dtype=x.dtype, device=x.device)
+        theta[:, 0, 0] = sx
+        theta[:, 1, 1] = sy
+        theta = theta.expand(x.shape[0], 2, 3)
 
         grid = F.affine_grid(theta, x.shape)
         x = F.grid_sample(x, grid)
@@ -112,16 +331,13 @@ class DiffAug():
         # [-180, 180], 90: anticlockwise 90 degree
         ratio = self.ratio_rotate
 
-        if batch:
-            theta = (np.random.uniform() - 0.5) * 2 * ratio / 180 * float(np.pi)
-            theta = [[np.cos(theta), np.sin(-theta), 0], [np.sin(theta), np.cos(theta), 0]]
-            theta = torch.tensor(theta, dtype=torch.float, device=x.device)
-            theta = theta.expand(x.shape[0], 2, 3)
-        else:
-            theta = (np.random.uniform(size=x.shape[0]) - 0.5) * 2 * ratio / 180 * float(np.pi)
-            theta = [[[np.cos(theta[i]), np.sin(-theta[i]), 0],
-                      [np.sin(theta[i]), np.cos(theta[i]), 0]] for i in range(x.shape[0])]
-            theta = torch.tensor(theta, dtype=torch.float, device=x.device)
+        angle = (self.rand(x, batch) - 0.5) * 2 * ratio / 180 * float(np.pi)
+        theta = torch.zeros(len(angle), 2, 3, dtype=x.dtype, device=x.device)
+        theta[:, 0, 0] = torch.cos(angle)
+        theta[:, 0, 1] = -torch.sin(angle)
+        theta[:, 1, 0] = torch.sin(angle)
+        theta[:, 1, 1] = torch.cos(angle)
+        theta = theta.expand(x.shape[0], 2, 3)
 
         grid = F.affine_grid(theta, x.shape)
         x = F.grid_sample(x, grid)
@@ -130,24 +346,14 @@ class DiffAug():
     def flip_fn(self, x, batch=True):
         prob = self.prob_flip
 
-        if batch:
-            coin = np.random.uniform()
-            if coin < prob:
-                return x.flip(3)
-            else:
-                return x
-        else:
-            randf = torch.rand(x.size(0), 1, 1, 1, device=x.device)
-            return torch.where(randf < prob, x.flip(3), x)
+        randf = self.rand(x, batch, 1, 1, 1)
+        return torch.where(randf < prob, x.flip(3), x)
 
     def brightness_fn(self, x, batch=True):
         # mean
         ratio = self.brightness
 
-        if batch:
-            randb = np.random.uniform()
-        else:
-            randb = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device)
+        randb = self.rand(x, batch, 1, 1, 1)
         x = x + (randb - 0.5) * ratio
         return x
 
@@ -156,10 +362,7 @@ class DiffAug():
         ratio = self.saturation
 
         x_mean = x.mean(dim=1, keepdim=True)
-        if batch:
-            rands = np.random.uniform()
-        else:
-            rands = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device)
+        rands = self.rand(x, batch, 1, 1, 1)
         x = (x - x_mean) * (rands * ratio) + x_mean
         return x
 
@@ -168,10 +371,7 @@ class DiffAug():
         ratio = self.contrast
 
         x_mean = x.mean(dim=[1, 2, 3], keepdim=True)
-        if batch:
-            randc = np.random.uniform()
-        else:
-            randc = torch.rand(x.size(0), 1, 1, 1, dtype=x.dtype, device=x.device)
+        randc = self.rand(x, batch, 1, 1, 1)
         x = (x - x_mean) * (randc + ratio) + x_mean
         return x
 
@@ -179,22 +379,12 @@ class DiffAug():
         ratio = self.ratio_crop_pad
 
         shift_y = int(x.size(3) * ratio + 0.5)
-        if batch:
-            translation_y = np.random.randint(-shift_y, shift_y + 1)
-        else:
-            translation_y = torch.randint(-shift_y,
-                                          shift_y + 1,
-                                          size=[x.size(0), 1, 1],
-                                          device=x.device)
-
-        grid_batch, grid_x, grid_y = torch.meshgrid(
-            torch.arange(x.size(0), dtype=torch.long, device=x.device),
-            torch.arange(x.size(2), dtype=torch.long, device=x.device),
-            torch.arange(x.size(3), dtype=torch.long, device=x.device),
-        )
+        translation_y = self.randint(x, batch, -shift_y, shift_y + 1, 1, 1)
+
+        grid_batch, grid_x, grid_y = self.grid(x)
         grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
         x_pad = F.pad(x, (1, 1))
-        x = x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
+        x = x_pad[grid_batch, :, grid_x, grid_y].permute(0, 3, 1, 2)
         return x
 
     def crop_fn(self, x, batch=True):
@@ -202,86 +392,27 @@ class DiffAug():
         ratio = self.ratio_crop_pad
 
         shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-        if batch:
-            translation_x = np.random.randint(-shift_x, shift_x + 1)
-            translation_y = np.random.randint(-shift_y, shift_y + 1)
-        else:
-            translation_x = torch.randint(-shift_x,
-                                          shift_x + 1,
-                                          size=[x.size(0), 1, 1],
-                                          device=x.device)
-
-            translation_y = torch.randint(-shift_y,
-                                          shift_y + 1,
-                                          size=[x.size(0), 1, 1],
-                                          device=x.device)
-
-        grid_batch, grid_x, grid_y = torch.meshgrid(
-            torch.arange(x.size(0), dtype=torch.long, device=x.device),
-            torch.arange(x.size(2), dtype=torch.long, device=x.device),
-            torch.arange(x.size(3), dtype=torch.long, device=x.device),
-        )
+        translation_x = self.randint(x, batch, -shift_x, shift_x + 1, 1, 1)
+        translation_y = self.randint(x, batch, -shift_y, shift_y + 1, 1, 1)
+
+        grid_batch, grid_x, grid_y = self.grid(x)
         grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
         grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
         x_pad = F.pad(x, (1, 1, 1, 1))
-        x = x_pad.permute(0, 2, 3, 1).contiguous()[grid_batch, grid_x, grid_y].permute(0, 3, 1, 2)
+        x = x_pad[grid_batch, :, grid_x, grid_y].permute(0, 3, 1, 2)
         return x
 
     def cutout_fn(self, x, batch=True):
-        ratio = self.ratio_cutout
-        cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
-
-        if batch:
-            offset_x = np.random.randint(0, x.size(2) + (1 - cutout_size[0] % 2))
-            offset_y = np.random.randint(0, x.size(3) + (1 - cutout_size[1] % 2))
-        else:
-            offset_x = torch.randint(0,
-                                     x.size(2) + (1 - cutout_size[0] % 2),
-                                     size=[x.size(0), 1, 1],
-                                     device=x.device)
-
-            offset_y = torch.randint(0,
-                                     x.size(3) + (1 - cutout_size[1] % 2),
-                                     size=[x.size(0), 1, 1],
-                                     device=x.device)
-
-        grid_batch, grid_x, grid_y = torch.meshgrid(
-            torch.arange(x.size(0), dtype=torch.long, device=x.device),
-            torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
-            torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
-        )
-        grid_x = torch.clamp(grid_x + offset_x - cutout_size[0] // 2, min=0, max=x.size(2) - 1)
-        grid_y = torch.clamp(grid_y + offset_y - cutout_size[1] // 2, min=0, max=x.size(3) - 1)
-        mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
-        mask[grid_batch, grid_x, grid_y] = 0
-        x = x * mask.unsqueeze(1)
+        x = x * self.cutout_mask(x, batch)
         return x
 
     def cutout_inv_fn(self, x, batch=True):
         ratio = self.ratio_cutout
         cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
 
-        if batch:
-            offset_x = np.random.randint(0, x.size(2) - cutout_size[0])
-            offset_y = np.random.randint(0, x.size(3) - cutout_size[1])
-        else:
-            offset_x = torch.randint(0,
-                                     x.size(2) - cutout_size[0],
-                                     size=[x.size(0), 1, 1],
-                                     device=x.device)
-            offset_y = torch.randint(0,
-                                     x.size(3) - cutout_size[1],
-                                     size=[x.size(0), 1, 1],
-                                     device=x.device)
-
-        grid_batch, grid_x, grid_y = torch.meshgrid(
-            torch.arange(x.size(0), dtype=torch.long, device=x.device),
-            torch.arange(cutout_size[0], dtype=torch.long, device=x.device),
-            torch.arange(cutout_size[1], dtype=torch.long, device=x.device),
-        )
-        grid_x = torch.clamp(grid_x + offset_x, min=0, max=x.size(2) - 1)
-        grid_y = torch.clamp(grid_y + offset_y, min=0, max=x.size(3) - 1)
-        mask = torch.zeros(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
-        mask[grid_batch, grid_x, grid_y] = 1.
-        x = x * mask.unsqueeze(1)
+        offset_x = self.randint(x, batch, 0, x.size(2) - cutout_size[0], 1, 1)
+        offset_y = self.randint(x, batch, 0, x.size(3) - cutout_size[1], 1, 1)
+
+        mask = self.box(x, offset_x, offset_y, cutout_size)
+        x = x * mask.unsqueeze(1).to(x.dtype)
         return x
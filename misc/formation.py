@@ -0,0 +1,187 @@
+"""Multi-formation encoding/decoding of condensed data.
+Inputs are ordered by class (nclass blocks of equal size) and decoded outputs keep that order:
+for each class, crops of the same location are grouped (location-major, sample-minor).
+"""
+import hashlib
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+from math import ceil
+
+_DECODE_CACHE = OrderedDict()
+
+
+def decode_zoom(img, target, factor, size=-1, nclass=1):
+    """Uniform multi-formation: split each image into factor x factor crops and resize them back
+    """
+    if size == -1:
+        size = img.shape[-1]
+
+    h = img.shape[-1]
+    remained = h % factor
+    if remained > 0:
+        img = F.pad(img, pad=(0, factor - remained, 0, factor - remained), value=0.5)
+    s_crop = ceil(h / factor)
+    n_crop = factor**2
+
+    n = len(img) // nclass
+    c = img.shape[1]
+    # (class, sample, ch, i, h, j, w) -> (class, i, j, sample, ch, h, w)
+    cropped = img.reshape(nclass, n, c, factor, s_crop, factor, s_crop)
+    cropped = cropped.permute(0, 3, 5, 1, 2, 4, 6).reshape(-1, c, s_crop, s_crop)
+    data_dec = F.interpolate(cropped, size=size, mode='bilinear')
+    target_dec = target.reshape(nclass, 1, n).expand(nclass, n_crop, n).reshape(-1)
+
+    return data_dec, target_dec
+
+
+def _cat_class(decoded, nclass):
+    """Concatenate decoded outputs per class
+    """
+    data = torch.cat([d.reshape(nclass, -1, *d.shape[1:]) for d, _ in decoded], dim=1)
+    target = torch.cat([t.reshape(nclass, -1) for _, t in decoded], dim=1)
+    return data.reshape(-1, *data.shape[2:]), target.reshape(-1)
+
+
+def decode_zoom_multi(img, target, factor_max, size=-1, nclass=1):
+    """Multi-scale multi-formation
+    """
+    decoded = [
+        decode_zoom(img, target, factor, size=size, nclass=nclass)
+        for factor in range(1, factor_max + 1)
+    ]
+    return _cat_class(decoded, nclass)
+
+
+def bound_split(n_img, factor_max, bound=128):
+    """Number of images decoded with each factor (from factor_max to 1) under the bound
+    """
+    bound_cur = bound - n_img
+    budget = n_img
+
+    split = []
+    decoded_total = 0
+    for factor in range(factor_max, 0, -1):
+        decode_size = factor**2
+        if factor > 1:
+            n = min(bound_cur // decode_size, budget)
+        else:
+            n = budget
+        split.append((factor, n))
+
+        budget -= n
+        decoded_total += n * decode_size
+        bound_cur = bound - decoded_total - budget
+
+        if budget == 0:
+            break
+    return split
+
+
+def decode_zoom_bound(img, target, factor_max, bound=128, size=-1, nclass=1):
+    """Uniform multi-formation with bounded number of synthetic data (per class)
+    """
+    n = len(img) // nclass
+    img = img.reshape(nclass, n, *img.shape[1:])
+    target = target.reshape(nclass, n)
+
+    decoded = []
+    idx = 0
+    for factor, n_f in bound_split(n, factor_max, bound=bound):
+        img_f = img[:, idx:idx + n_f].reshape(-1, *img.shape[2:])
+        target_f = target[:, idx:idx + n_f].reshape(-1)
+        decoded.append(decode_zoom(img_f, target_f, factor, size=size, nclass=nclass))
+        idx += n_f
+
+    return _cat_class(decoded, nclass)
+
+
+def decode(data, target, factor, decode_type='single', bound=128, size=-1, nclass=1):
+    """Multi-formation
+    """
+    if factor > 1:
+        if decode_type == 'multi':
+            data, target = decode_zoom_multi(data, target, factor, size=size, nclass=nclass)
+        elif decode_type == 'bound':
+            data, target = decode_zoom_bound(data,
+                                             target,
+                                             factor,
+                                             bound=bound,
+                                             size=size,
+                                             nclass=nclass)
+        else:
+            data, target = decode_zoom(data, target, factor, size=size, nclass=nclass)
+
+    return data, target
+
+
+def encode(img, size, factor, nclass=1):
+    """Inverse of the uniform multi-formation: tile factor x factor resized images into one.
+       img is ordered (class, location i, location j, sample) and the first (size % factor)
+       rows/columns of tiles are one pixel larger.
+    """
+    n = len(img) // (nclass * factor**2)
+    c, h, w = img.shape[1:]
+    img = img.reshape(nclass, factor, factor, n, c, h, w)
+
+    s = size // factor
+    remained = size % factor
+    groups = [(slice(0, remained), s + 1), (slice(remained, factor), s)]
+    groups = [(loc, s_tile) for loc, s_tile in groups if loc.stop > loc.start]
+
+    rows = []
+    for loc_i, h_r in groups:
+        cols = []
+        for loc_j, w_r in groups:
+            tiles = img[:, loc_i, loc_j]
+            n_i, n_j = tiles.shape[1:3]
+            tiles = F.interpolate(tiles.reshape(-1, c, h, w), size=(h_r, w_r))
+            # (class, i, j, sample, ch, h, w) -> (class, sample, ch, i, h, j, w)
+            tiles = tiles.reshape(nclass, n_i, n_j, n, c, h_r, w_r).permute(0, 3, 4, 1, 5, 2, 6)
+            cols.append(tiles.reshape(nclass * n, c, n_i * h_r, n_j * w_r))
+        rows.append(torch.cat(cols, dim=-1))
+
+    return torch.cat(rows, dim=-2)
+
+
+def tensor_hash(*tensors):
+    """Content hash (sha1) of tensors, including their shapes and dtypes
+    """
+    h = hashlib.sha1()
+    for x in tensors:
+        x = x.detach().contiguous().cpu()
+        h.update(f'{tuple(x.shape)}{x.dtype}'.encode())
+        h.update(x.numpy().tobytes())
+    return h.hexdigest()
+
+
+def decode_cached(data,
+                  target,
+                  factor,
+                  decode_type='single',
+                  bound=128,
+                  size=-1,
+                  nclass=1,
+                  maxsize=2):
+    """decode() memoized in memory (the last maxsize results)
+       by the content of data/target and the decode parameters.
+    """
+    if factor <= 1:
+        return data, target
+
+    key = f'{tensor_hash(data, target)}_{factor}_{decode_type}_{bound}_{size}_{nclass}'
+    if key in _DECODE_CACHE:
+        _DECODE_CACHE.move_to_end(key)
+        return _DECODE_CACHE[key]
+
+    data_dec, target_dec = decode(data.detach(),
+                                  target.detach(),
+                                  factor,
+                                  decode_type=decode_type,
+                                  bound=bound,
+                                  size=size,
+                                  nclass=nclass)
+    _DECODE_CACHE[key] = (data_dec, target_dec)
+    while len(_DECODE_CACHE) > maxsize:
+        _DECODE_CACHE.popitem(last=False)
+    return data_dec, target_dec
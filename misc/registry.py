@@ -0,0 +1,164 @@
+"""Content-addressed registry of condensation runs.
+A run is identified by the hash of its effective arguments (after argument.py) and the code version,
+and lives in RUN_DIR/<hash> with a status file. The human-readable args.save_dir links to it.
+"""
+import os
+import re
+import glob
+import fcntl
+import json
+import time
+import socket
+import hashlib
+import subprocess
+
+RUN_DIR = './results/runs'
+STATUS_FILE = 'status.json'
+LOCK_FILE = 'status.lock'
+# Arguments that do not change the condensed data
+EXCLUDE_KEYS = [
+    'save_dir', 'tag', 'name', 'workers', 'time', 'test', 'rerun', 'registry', 'parallel_eval',
+    'eval_workers', 'eval_cache'
+]
+
+
+def code_version(root='.'):
+    """Git commit of the code plus a hash of uncommitted changes to any .py file of the repository
+       (None outside of a git repo)
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=root,
+                                capture_output=True,
+                                text=True,
+                                check=True).stdout.strip()
+        # Pathspecs are relative to cwd, ':(top)' makes the pattern cover the whole repository
+        diff = subprocess.run(['git', 'diff', 'HEAD', '--', ':(top)*.py'],
+                              cwd=root,
+                              capture_output=True,
+                              check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    if diff:
+        commit += '_' + hashlib.sha1(diff).hexdigest()[:12]
+    return commit
+
+
+def run_hash(args, version=None):
+    """Hash of the effective arguments and the code version
+    """
+    config = {k: v for k, v in vars(args).items() if k not in EXCLUDE_KEYS}
+    config['code_version'] = version
+    config = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha1(config.encode()).hexdigest()
+
+
+def read_status(run_dir):
+    path = os.path.join(run_dir, STATUS_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_status(run_dir, state, **kwargs):
+    status = {
+        'state': state,
+        'pid': os.getpid(),
+        'host': socket.gethostname(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    status.update(kwargs)
+    path = os.path.join(run_dir, STATUS_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def is_running(status):
+    """Whether another process is working on the run.
+       Runs of other hosts are regarded as running since their processes cannot be checked.
+    """
+    if status is None or status['state'] != 'running':
+        return False
+    if status['host'] != socket.gethostname():
+        return True
+    return status['pid'] != os.getpid() and pid_alive(status['pid'])
+
+
+def latest_snapshot(run_dir):
+    """(iteration, path) of the last saved condensed data, (0, None) if there is none
+    """
+    snapshots = []
+    for path in glob.glob(os.path.join(run_dir, 'data*.pt')):
+        it = re.findall(r'data(\d+)\.pt$', path)
+        if it:
+            snapshots.append((int(it[0]), path))
+    return max(snapshots) if snapshots else (0, None)
+
+
+def link(save_dir, run_dir):
+    """Point the human-readable save_dir to run_dir (existing directories are left untouched)
+    """
+    if os.path.islink(save_dir):
+        if os.path.realpath(save_dir) == os.path.realpath(run_dir):
+            return True
+        os.remove(save_dir)
+    elif os.path.exists(save_dir):
+        return False
+
+    os.makedirs(os.path.dirname(os.path.abspath(save_dir)), exist_ok=True)
+    target = os.path.relpath(os.path.abspath(run_dir), os.path.dirname(os.path.abspath(save_dir)))
+    os.symlink(target, save_dir)
+    return True
+
+
+def claim(args, rerun=False):
+    """Register the run of args. Returns (state, run_dir, resume_iter, snapshot path) where state is
+       'done' or 'running' for runs to skip, and 'new' or 'resume' for runs claimed by this process.
+       The status is read and written under an exclusive lock, so concurrent launches of the same
+       configuration claim it only once.
+    """
+    version = code_version(os.path.dirname(os.path.abspath(__file__)))
+    key = run_hash(args, version)
+    run_dir = os.path.join(RUN_DIR, key)
+    os.makedirs(run_dir, exist_ok=True)
+
+    with open(os.path.join(run_dir, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            status = read_status(run_dir)
+            if is_running(status):
+                # A live process owns the run, even with rerun
+                return 'running', run_dir, 0, None
+            if not rerun and status is not None and status['state'] == 'done':
+                return 'done', run_dir, 0, None
+
+            it, path = (0, None) if rerun else latest_snapshot(run_dir)
+            write_status(run_dir,
+                         'running',
+                         code_version=version,
+                         save_dir=args.save_dir,
+                         start_iter=it)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return ('resume' if path is not None else 'new'), run_dir, it, path
+
+
+def finish(run_dir):
+    status = read_status(run_dir) or {}
+    write_status(run_dir,
+                 'done',
+                 code_version=status.get('code_version'),
+                 save_dir=status.get('save_dir'))
@@ -1,16 +1,85 @@
 # original code: https://github.com/eladhoffer/convNet.pytorch/blob/master/preprocess.py
 
 import torch
+import torch.nn.functional as F
 import random
 import numpy as np
 import os
 import time
+import hashlib
+import socket
 import matplotlib
 import matplotlib.pyplot as plt
 
 matplotlib.use('Agg')
 
-__all__ = ["Compose", "Lighting", "ColorJitter"]
+__all__ = [
+    "Compose", "Lighting", "ColorJitter", "BatchRandomCrop", "BatchRandomHorizontalFlip",
+    "BatchRandomResizedCrop", "BatchLighting", "BatchColorJitter"
+]
+
+
+FEATURE_DIR = './results/features'
+
+
+def hash_file(path, chunk_size=2**20):
+    """sha1 of the file content
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_state(state_dict):
+    """sha1 of the model parameters and buffers
+    """
+    h = hashlib.sha1()
+    for k in sorted(state_dict.keys()):
+        v = state_dict[k].detach().contiguous().cpu()
+        h.update(k.encode())
+        h.update(v.numpy().tobytes())
+    return h.hexdigest()
+
+
+def cached_features(key, batches, n, cache_dir=FEATURE_DIR):
+    """Stream (feature, target) batches into memory-mapped .npy files named by the key.
+       When the cache exists, batches are not consumed and the memory-mapped features are returned.
+    """
+    path = os.path.join(cache_dir, key)
+    if os.path.isfile(f'{path}_feat.npy'):
+        print(f"Load cached features {path}")
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Temporary files are per process, the cache appears with the final rename of the features
+        tmp = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+        features = None
+        targets = np.zeros(n, dtype=np.int64)
+        i = 0
+        for feat, target in batches:
+            feat = feat.reshape(feat.size(0), -1).float().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(f'{tmp}_feat.npy',
+                                                     mode='w+',
+                                                     dtype=np.float32,
+                                                     shape=(n, feat.shape[1]))
+            features[i:i + len(feat)] = feat
+            targets[i:i + len(feat)] = target.cpu().numpy()
+            i += len(feat)
+        assert i == n, f"Expected {n} features but got {i}"
+
+        features.flush()
+        del features
+        np.save(f'{tmp}_target.npy', targets)
+        os.replace(f'{tmp}_target.npy', f'{path}_target.npy')
+        os.replace(f'{tmp}_feat.npy', f'{path}_feat.npy')
+        print(f"Save features {path}")
+
+    # Copy-on-write mapping (the cache file is never modified)
+    features = np.load(f'{path}_feat.npy', mmap_mode='c')
+    targets = np.load(f'{path}_target.npy')
+    return torch.from_numpy(features), torch.from_numpy(targets)
 
 
 def dist_l2(data, target):
@@ -24,8 +93,8 @@ def get_time():
 
 
 class Logger():
-    def __init__(self, path):
-        self.logger = open(os.path.join(path, 'log.txt'), 'w')
+    def __init__(self, path, mode='w'):
+        self.logger = open(os.path.join(path, 'log.txt'), mode)
 
     def __call__(self, string, end='\n', print_=True):
         if print_:
@@ -84,6 +153,76 @@ def accuracy(output, target, topk=(1, )):
     return res
 
 
+def accuracy_counts(output, target, maxk=5):
+    """Numbers of correct top-1, ..., top-maxk predictions (a float tensor of size maxk)"""
+    _, pred = output.topk(maxk, 1, True, True)
+    hits = pred.eq(target.reshape(-1, 1)).float()
+    return hits.sum(0).cumsum(0)
+
+
+def fit_learning_curve(epochs, accs, epoch_final):
+    """Fit acc(t) = a - b * t^(-c) (least squares for a, b over a grid of c)
+       and return the accuracy extrapolated to epoch_final
+    """
+    t = np.array(epochs, dtype=np.float64)
+    y = np.array(accs, dtype=np.float64)
+
+    best = None
+    for c in np.linspace(0.1, 3.0, 30):
+        x = np.stack([np.ones_like(t), -t**(-c)], axis=1)
+        coef = np.linalg.lstsq(x, y, rcond=None)[0]
+        sse = ((x @ coef - y)**2).sum()
+        if best is None or sse < best[0]:
+            best = (sse, coef, c)
+
+    _, (a, b), c = best
+    return a - b * epoch_final**(-c)
+
+
+# Two-sided 95% critical values of Student's t distribution (degrees of freedom 1-30)
+T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160,
+    2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056,
+    2.052, 2.048, 2.045, 2.042
+]
+
+
+def mean_ci(values):
+    """Mean, sample std and 95% confidence half-width of the mean
+    """
+    values = np.array(values, dtype=np.float64)
+    n = len(values)
+    if n < 2:
+        return values.mean(), 0., float('inf')
+    std = values.std(ddof=1)
+    t = T_95[n - 2] if n - 1 <= len(T_95) else 1.96
+    return values.mean(), std, t * std / np.sqrt(n)
+
+
+class DeviceMeter(object):
+    """Accumulates a vector of per-sample sums on the device.
+       Values are materialized only in flush(), which reports the averages to AverageMeters.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sum = None
+        self.count = 0
+
+    def update(self, val, n=1):
+        val = val.detach()
+        self.sum = val if self.sum is None else self.sum + val
+        self.count += n
+
+    def flush(self, *meters):
+        if self.count > 0:
+            avgs = (self.sum / self.count).tolist()
+            for meter, avg in zip(meters, avgs):
+                meter.update(avg, self.count)
+        self.reset()
+
+
 class AverageMeter(object):
     """Computes and stores the average and current value"""
     def __init__(self):
@@ -190,9 +329,9 @@ class Compose(object):
     def __init__(self, transforms):
         self.transforms = transforms
 
-    def __call__(self, img):
+    def __call__(self, img, **kwargs):
         for t in self.transforms:
-            img = t(img)
+            img = t(img, **kwargs)
         return img
 
     def __repr__(self):
@@ -227,6 +366,10 @@ class Lighting(object):
         else:
             return img + rgb.view(3, 1, 1).expand_as(img)
 
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(alphastd={self.alphastd}, '
+                f'eigval={self.eigval.tolist()}, eigvec={self.eigvec.tolist()})')
+
 
 class Grayscale(object):
     def __call__(self, img):
@@ -288,6 +431,10 @@ class ColorJitter(object):
         # print(transform)
         return transform(img)
 
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(brightness={self.brightness}, '
+                f'contrast={self.contrast}, saturation={self.saturation})')
+
 
 class CutOut():
     def __init__(self, ratio, device='cpu'):
@@ -319,5 +466,178 @@ class Normalize():
         self.mean = torch.tensor(mean, device=device).reshape(1, len(mean), 1, 1)
         self.std = torch.tensor(std, device=device).reshape(1, len(mean), 1, 1)
 
-    def __call__(self, x, seed=-1):
-        return (x - self.mean) / self.std
\ No newline at end of file
+    def __call__(self, x, seed=-1, step=-1):
+        return (x - self.mean) / self.std
+
+
+class BatchRandomCrop():
+    """RandomCrop with zero padding and per-sample offsets (NCHW or CHW tensors)"""
+    def __init__(self, size, padding=4):
+        self.size = size
+        self.padding = padding
+
+    def __call__(self, img):
+        x = img if img.dim() == 4 else img.unsqueeze(0)
+        n, _, h, w = x.shape
+        p = self.padding
+        x = F.pad(x, (p, p, p, p))
+
+        off_h = torch.randint(h + 2 * p - self.size + 1, size=[n, 1], device=x.device)
+        off_w = torch.randint(w + 2 * p - self.size + 1, size=[n, 1], device=x.device)
+        grid = torch.arange(self.size, device=x.device)
+        rows = (off_h + grid).unsqueeze(2)
+        cols = (off_w + grid).unsqueeze(1)
+        batch = torch.arange(n, device=x.device).reshape(n, 1, 1)
+
+        x = x[batch, :, rows, cols].permute(0, 3, 1, 2).contiguous()
+        return x if img.dim() == 4 else x[0]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(size={self.size}, padding={self.padding})'
+
+
+class BatchRandomHorizontalFlip():
+    """RandomHorizontalFlip with per-sample coins (NCHW or CHW tensors)"""
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, img):
+        x = img if img.dim() == 4 else img.unsqueeze(0)
+        coin = torch.rand(x.size(0), 1, 1, 1, device=x.device) < self.p
+        x = torch.where(coin, x.flip(3), x)
+        return x if img.dim() == 4 else x[0]
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(p={self.p})'
+
+
+class BatchRandomResizedCrop():
+    """RandomResizedCrop with per-sample boxes (NCHW or CHW tensors).
+       Boxes follow transforms.RandomResizedCrop and all crops are resampled by one grid_sample.
+    """
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), n_try=10):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.n_try = n_try
+
+    def get_params(self, n, h, w, device):
+        area = h * w
+        target_area = area * torch.empty(n, self.n_try, device=device).uniform_(*self.scale)
+        log_ratio = (np.log(self.ratio[0]), np.log(self.ratio[1]))
+        aspect = torch.exp(torch.empty(n, self.n_try, device=device).uniform_(*log_ratio))
+
+        w_crop = torch.round(torch.sqrt(target_area * aspect))
+        h_crop = torch.round(torch.sqrt(target_area / aspect))
+        valid = (w_crop > 0) & (w_crop <= w) & (h_crop > 0) & (h_crop <= h)
+
+        # First valid trial, otherwise the center crop of transforms.RandomResizedCrop
+        first = valid.float().argmax(1, keepdim=True)
+        found = valid.any(1)
+        w_crop = w_crop.gather(1, first).squeeze(1)
+        h_crop = h_crop.gather(1, first).squeeze(1)
+
+        in_ratio = w / h
+        if in_ratio < min(self.ratio):
+            w_fb, h_fb = w, round(w / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            w_fb, h_fb = round(h * max(self.ratio)), h
+        else:
+            w_fb, h_fb = w, h
+        w_crop = torch.where(found, w_crop, torch.full_like(w_crop, w_fb))
+        h_crop = torch.where(found, h_crop, torch.full_like(h_crop, h_fb))
+
+        i = torch.floor(torch.rand(n, device=device) * (h - h_crop + 1))
+        j = torch.floor(torch.rand(n, device=device) * (w - w_crop + 1))
+        i = torch.where(found, i, torch.floor((h - h_crop) / 2))
+        j = torch.where(found, j, torch.floor((w - w_crop) / 2))
+        return i, j, h_crop, w_crop
+
+    def __call__(self, img):
+        x = img if img.dim() == 4 else img.unsqueeze(0)
+        n, c, h, w = x.shape
+        i, j, h_crop, w_crop = self.get_params(n, h, w, x.device)
+
+        theta = torch.zeros(n, 2, 3, dtype=x.dtype, device=x.device)
+        theta[:, 0, 0] = w_crop / w
+        theta[:, 0, 2] = (2 * j + w_crop) / w - 1
+        theta[:, 1, 1] = h_crop / h
+        theta[:, 1, 2] = (2 * i + h_crop) / h - 1
+        grid = F.affine_grid(theta, (n, c, self.size, self.size), align_corners=False)
+        x = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        return x if img.dim() == 4 else x[0]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(size={self.size}, scale={self.scale}, '
+                f'ratio={self.ratio}, n_try={self.n_try})')
+
+
+class BatchLighting():
+    """Lighting noise with per-sample alpha (NCHW or CHW tensors)"""
+    def __init__(self, alphastd, eigval, eigvec, device='cpu'):
+        self.alphastd = alphastd
+        self.eigval = torch.tensor(eigval, device=device)
+        self.eigvec = torch.tensor(eigvec, device=device)
+
+    def __call__(self, img):
+        if self.alphastd == 0:
+            return img
+
+        x = img if img.dim() == 4 else img.unsqueeze(0)
+        eigval = self.eigval.to(device=x.device, dtype=x.dtype)
+        eigvec = self.eigvec.to(device=x.device, dtype=x.dtype)
+        alpha = torch.randn(x.size(0), 3, dtype=x.dtype, device=x.device) * self.alphastd
+        rgb = (eigvec.unsqueeze(0) * alpha.unsqueeze(1) * eigval.reshape(1, 1, 3)).sum(2)
+
+        x = x + rgb.reshape(-1, 3, 1, 1)
+        return x if img.dim() == 4 else x[0]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(alphastd={self.alphastd}, '
+                f'eigval={self.eigval.tolist()}, eigvec={self.eigvec.tolist()})')
+
+
+class BatchColorJitter():
+    """ColorJitter with per-sample factors and per-sample order (NCHW or CHW tensors)"""
+    def __init__(self, brightness=0.4, contrast=0.4, saturation=0.4):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @staticmethod
+    def grayscale(x):
+        return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+    def __call__(self, img):
+        x = img if img.dim() == 4 else img.unsqueeze(0)
+        n = x.size(0)
+
+        ops = []
+        if self.brightness != 0:
+            ops.append((self.brightness, lambda x: torch.zeros_like(x)))
+        if self.contrast != 0:
+            ops.append((self.contrast, lambda x: self.grayscale(x).mean(dim=[1, 2, 3], keepdim=True)))
+        if self.saturation != 0:
+            ops.append((self.saturation, self.grayscale))
+        if len(ops) == 0:
+            return img
+
+        var = torch.tensor([op[0] for op in ops], dtype=x.dtype, device=x.device)
+        alpha = (torch.rand(n, len(ops), dtype=x.dtype, device=x.device) * 2 - 1) * var
+        order = torch.rand(n, len(ops), device=x.device).argsort(dim=1)
+
+        # At each stage, every sample blends towards the target of its own k-th op
+        for k in range(len(ops)):
+            target = torch.zeros_like(x)
+            weight = torch.zeros(n, 1, 1, 1, dtype=x.dtype, device=x.device)
+            for idx, (_, target_fn) in enumerate(ops):
+                slct = (order[:, k] == idx).reshape(n, 1, 1, 1)
+                target = torch.where(slct, target_fn(x).expand_as(x), target)
+                weight = torch.where(slct, alpha[:, idx].reshape(n, 1, 1, 1), weight)
+            x = x + weight * (target - x)
+
+        return x if img.dim() == 4 else x[0]
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(brightness={self.brightness}, '
+                f'contrast={self.contrast}, saturation={self.saturation})')
@@ -42,7 +42,13 @@ def pretrain(args, logger, device='cuda'):
                                     aug=aug_rand,
                                     mixup=args.mixup_net,
                                     logger=logger)
-        top1_val, _, _ = validate(args, val_loader, model, criterion, epoch, logger=logger)
+        top1_val, _, _ = validate(args,
+                                  val_loader,
+                                  model,
+                                  criterion,
+                                  epoch,
+                                  logger=logger,
+                                  subset=epoch < epoch_max - 1)
         print(f"[Epoch {epoch}] Train acc: {top1:.1f} (loss: {loss:.3f}), Val acc: {top1_val:.1f}")
 
         if epoch >= args.pt_from:
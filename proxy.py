@@ -0,0 +1,205 @@
+import os
+import re
+import copy
+import glob
+import time
+import hashlib
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from train import define_model
+from data import load_val_cache, dataset_key, MEANS, STDS
+from coreset import herding_ckpt, load_ckpt
+from misc import utils
+
+
+def normalize(args, data, normalized=False):
+    if normalized:
+        return data
+    mean = torch.tensor(MEANS[args.dataset], device=data.device).reshape(1, -1, 1, 1)
+    std = torch.tensor(STDS[args.dataset], device=data.device).reshape(1, -1, 1, 1)
+    return (data - mean) / std
+
+
+def random_convnets(args, nclass, n_model=4, seed=0):
+    """ConvNets at random initialization (fixed seeds, so that snapshots share the kernel)
+    """
+    args_conv = copy.copy(args)
+    if args.net_type != 'convnet':
+        args_conv.net_type = 'convnet'
+        args_conv.depth = 3
+        args_conv.width = 1.0
+        args_conv.norm_type = 'instance'
+
+    models = []
+    with torch.random.fork_rng(devices=[torch.cuda.current_device()]):
+        for i in range(n_model):
+            torch.manual_seed(seed + i)
+            models.append(define_model(args_conv, nclass).cuda().eval())
+    return models
+
+
+@torch.no_grad()
+def random_features(models, input):
+    """Concatenated features of the random networks (inner products average the kernels)
+    """
+    features = []
+    for model in models:
+        feat = model.embed(input)
+        features.append(feat / (feat.size(1) * len(models))**0.5)
+    return torch.cat(features, dim=1)
+
+
+@torch.no_grad()
+def kernel_proxy(args,
+                 data,
+                 target,
+                 val_loader,
+                 n_model=4,
+                 reg=1e-3,
+                 batch_size=500,
+                 normalized=False,
+                 logger=print):
+    """Kernel ridge regression from the (decoded) condensed data to the validation set
+       with the random-feature kernel of ConvNets at initialization. No network is trained.
+       The regression is solved and evaluated in chunks on CPU.
+       Data are normalized here unless they are stored normalized (normalized=True).
+    """
+    start = time.time()
+    nclass = args.nclass
+    models = random_convnets(args, nclass, n_model=n_model)
+
+    feat_syn = []
+    for i in range(0, len(data), batch_size):
+        input = normalize(args, data[i:i + batch_size].cuda(), normalized=normalized)
+        feat_syn.append(random_features(models, input).cpu())
+    feat_syn = torch.cat(feat_syn).double()
+
+    # Centered one-hot regression targets
+    y = F.one_hot(target.cpu().long(), nclass).double() - 1. / nclass
+    kernel = feat_syn @ feat_syn.t()
+    kernel += reg * kernel.diagonal().mean() * torch.eye(len(kernel), dtype=kernel.dtype)
+    alpha = torch.linalg.solve(kernel, y)
+    # Predictions for new data are feat @ (feat_syn^T alpha)
+    weight = feat_syn.t() @ alpha
+
+    if args.val_cache != 'none':
+        val_loader = load_val_cache(val_loader,
+                                    args.dataset,
+                                    batch_size=args.val_batch_size,
+                                    dtype=args.val_cache)
+    correct = 0
+    n_val = 0
+    for input, target_val in val_loader:
+        feat = random_features(models, input.cuda()).cpu().double()
+        pred = (feat @ weight).argmax(1)
+        correct += (pred == target_val.cpu()).sum().item()
+        n_val += len(target_val)
+
+    acc = 100. * correct / n_val
+    logger(f'Kernel proxy acc: {acc:.1f} (data {len(data)}, {time.time() - start:.1f}s)')
+    return acc
+
+
+def probe_ckpt(args):
+    """Backbone checkpoint of the linear probe (args.probe_ckpt):
+       'pool' for the last checkpoint of a network in ./pretrained, 'herding' for the coreset
+       checkpoint, or a checkpoint path
+    """
+    if args.probe_ckpt == 'herding':
+        return herding_ckpt(args)
+    elif args.probe_ckpt == 'pool':
+        folder_list = sorted(glob.glob(f'./pretrained/{args.datatag}/{args.modeltag}_cut*'))
+        if len(folder_list) == 0:
+            raise AssertionError(f"No pretrained networks for {args.datatag}/{args.modeltag}!")
+        ckpt_list = glob.glob(os.path.join(folder_list[0], 'checkpoint*.pth.tar'))
+        return max(ckpt_list, key=lambda path: int(re.findall(r'checkpoint(\d+)', path)[-1]))
+    else:
+        return args.probe_ckpt
+
+
+@torch.no_grad()
+def penultimate(model, input):
+    """Input features of the last linear layer
+    """
+    features = []
+    fc = [m for m in model.modules() if isinstance(m, nn.Linear)][-1]
+    handle = fc.register_forward_pre_hook(lambda m, x: features.append(x[0]))
+    model(input)
+    handle.remove()
+    return features[0].reshape(len(input), -1)
+
+
+def fit_linear(feature, target, nclass, wd=5e-4, max_iter=100):
+    """Full-batch logistic regression (L-BFGS) on standardized features
+    """
+    mean = feature.mean(0, keepdim=True)
+    std = feature.std(0, keepdim=True) + 1e-6
+    x = (feature - mean) / std
+
+    weight = torch.zeros(x.size(1), nclass, device=x.device, requires_grad=True)
+    bias = torch.zeros(nclass, device=x.device, requires_grad=True)
+    optimizer = torch.optim.LBFGS([weight, bias],
+                                  lr=1,
+                                  max_iter=max_iter,
+                                  history_size=10,
+                                  line_search_fn='strong_wolfe')
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(x @ weight + bias, target) + wd * (weight**2).sum()
+        loss.backward()
+        return loss
+
+    optimizer.step(closure)
+    return lambda feat: ((feat - mean) / std) @ weight.detach() + bias.detach()
+
+
+def linear_probe(args, data, target, val_loader, batch_size=500, normalized=False, logger=print):
+    """Train a linear head on the frozen features of a pretrained backbone.
+       Validation features are extracted once per backbone and validation set and cached on disk.
+    """
+    start = time.time()
+    file_dir = probe_ckpt(args)
+    model = define_model(args, args.nclass).cuda().eval()
+    load_ckpt(model, file_dir, verbose=False)
+
+    val_dataset = val_loader.dataset
+    key = f'{utils.hash_file(file_dir)}_{dataset_key(val_dataset)}'
+    key = f'{args.dataset}_probe_' + hashlib.sha1(key.encode()).hexdigest()
+
+    def extract():
+        for input, target_val in val_loader:
+            yield penultimate(model, input.cuda(non_blocking=True)), target_val
+
+    feat_val, target_val = utils.cached_features(key, extract(), len(val_dataset))
+
+    feat_syn = []
+    for i in range(0, len(data), batch_size):
+        input = normalize(args, data[i:i + batch_size].cuda(), normalized=normalized)
+        feat_syn.append(penultimate(model, input))
+    feat_syn = torch.cat(feat_syn)
+    head = fit_linear(feat_syn, target.cuda().long(), args.nclass)
+
+    correct = 0
+    with torch.no_grad():
+        for i in range(0, len(feat_val), batch_size):
+            pred = head(feat_val[i:i + batch_size].cuda()).argmax(1)
+            correct += (pred.cpu() == target_val[i:i + batch_size]).sum().item()
+
+    acc = 100. * correct / len(feat_val)
+    logger(f'Linear probe acc: {acc:.1f} ({os.path.basename(os.path.dirname(file_dir))}, '
+           f'data {len(data)}, {time.time() - start:.1f}s)')
+    return acc
+
+
+def proxy_eval(args, data, target, val_loader, normalized=False, logger=print):
+    """Evaluate condensed data with the proxy given by args.proxy.
+       normalized: data are stored as normalized values (e.g., dsa/kip data and herding selections)
+    """
+    if args.proxy == 'kernel':
+        return kernel_proxy(args, data, target, val_loader, normalized=normalized, logger=logger)
+    elif args.proxy == 'linear':
+        return linear_probe(args, data, target, val_loader, normalized=normalized, logger=logger)
+    else:
+        raise AssertionError(f"Proxy {args.proxy} is not supported!")
@@ -2,8 +2,8 @@ from .strategy import Strategy
 from fast_pytorch_kmeans import KMeans
 import torch
 class KMeansSampling(Strategy):
-    def __init__(self, dataset, net):
-        super(KMeansSampling, self).__init__(dataset, net)
+    def __init__(self, dataset, net, cache_key=None):
+        super(KMeansSampling, self).__init__(dataset, net, cache_key=cache_key)
 
     def euclidean_dist(self,x, y):
         m, n = x.size(0), y.size(0)
@@ -17,7 +17,8 @@ class KMeansSampling(Strategy):
     def query(self, c,n):
         with torch.no_grad():
             unlabeled_idxs, unlabeled_data = self.dataset.get_class_data(c)
-            embeddings = self.get_embeddings(unlabeled_data)
+            cache_key = f'{self.cache_key}_c{c}' if self.cache_key is not None else None
+            embeddings = self.get_embeddings(unlabeled_data, cache_key=cache_key)
             kmeans = KMeans(n_clusters=n, mode='euclidean', verbose=1)
             labels = kmeans.fit_predict(embeddings)
             centers = kmeans.centroids
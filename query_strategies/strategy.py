@@ -4,15 +4,25 @@ import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
+from misc import utils
+
 class Strategy:
-    def __init__(self, dataset, net):
+    def __init__(self, dataset, net, cache_key=None):
         self.dataset = dataset
         self.net = net
+        # Embeddings are cached on disk under this key (the net should not change)
+        self.cache_key = cache_key
     def query(self, n):
         pass
     
-    def get_embeddings(self, data):
+    def get_embeddings(self, data, cache_key=None):
         embed=self.net.embed
+        if cache_key is not None:
+            def extract():
+                for datum in data:
+                    yield embed(datum[0].float()).detach(), datum[1]
+            features, _ = utils.cached_features(cache_key, extract(), len(data.dataset))
+            return features.to(next(self.net.parameters()).device)
         features = []
         for i_batch, datum in enumerate(data): 
             img = datum[0].float()
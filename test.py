@@ -1,21 +1,36 @@
 import os
+import json
+import time
+import queue
+import hashlib
 import numpy as np
-from math import ceil
 import torch
-import torch.nn as nn
-import torch.nn.functional as F
 import torchvision
+import torch.multiprocessing as mp
 from torch.utils.data import Subset
-from train import define_model, train
-from data import TensorDataset, ImageFolder, MultiEpochsDataLoader
+from train import define_model, train, train_ensemble
+from data import TensorDataset, ImageFolder, MultiEpochsDataLoader, TensorMemDataLoader
 from torchvision import datasets, transforms
 from data import save_img, transform_imagenet, transform_cifar, transform_svhn, transform_mnist, transform_fashion,transform_tiny
 import models.resnet as RN
 import models.densenet_cifar as DN
 from coreset import randomselect, herding
+from misc import formation
+from misc.utils import mean_ci
+from proxy import proxy_eval
 from efficientnet_pytorch import EfficientNet
 
 DATA_PATH = "./results"
+EVAL_DIR = "./results/eval"
+EVAL_CACHE_DIR = "./results/eval_cache"
+# Arguments that determine the evaluation results of given condensed data
+EVAL_KEYS = [
+    'dataset', 'nclass', 'dseed', 'size', 'nch', 'net_type', 'depth', 'width', 'norm_type',
+    'epochs', 'batch_size', 'lr', 'momentum', 'weight_decay', 'seed', 'mixup', 'beta', 'mix_p',
+    'dsa', 'dsa_strategy', 'augment', 'rrc', 'factor', 'decode_type', 'ensemble', 'fast_eval_tol',
+    'fast_eval_num_val', 'val_cache', 'val_subset', 'val_subset_seed', 'val_full_best',
+    'repeat_ci', 'repeat_max'
+]
 
 
 def return_data_path(args):
@@ -136,71 +151,14 @@ def remove_prefix_checkpoint(dictionary, prefix):
     return dictionary
 
 
-def decode_zoom(img, target, factor, size=-1):
-    if size == -1:
-        size = img.shape[-1]
-    resize = nn.Upsample(size=size, mode='bilinear')
-
-    h = img.shape[-1]
-    remained = h % factor
-    if remained > 0:
-        img = F.pad(img, pad=(0, factor - remained, 0, factor - remained), value=0.5)
-    s_crop = ceil(h / factor)
-    n_crop = factor**2
-
-    cropped = []
-    for i in range(factor):
-        for j in range(factor):
-            h_loc = i * s_crop
-            w_loc = j * s_crop
-            cropped.append(img[:, :, h_loc:h_loc + s_crop, w_loc:w_loc + s_crop])
-    cropped = torch.cat(cropped)
-    data_dec = resize(cropped)
-    target_dec = torch.cat([target for _ in range(n_crop)])
-
-    return data_dec, target_dec
-
-
-def decode_zoom_multi(img, target, factor_max):
-    data_multi = []
-    target_multi = []
-    for factor in range(1, factor_max + 1):
-        decoded = decode_zoom(img, target, factor)
-        data_multi.append(decoded[0])
-        target_multi.append(decoded[1])
-
-    return torch.cat(data_multi), torch.cat(target_multi)
-
-
-def decode_fn(data, target, factor, decode_type, bound=128):
-    if factor > 1:
-        if decode_type == 'multi':
-            data, target = decode_zoom_multi(data, target, factor)
-        else:
-            data, target = decode_zoom(data, target, factor)
-
-    return data, target
-
-
 def decode(args, data, target):
-    data_dec = []
-    target_dec = []
-    ipc = len(data) // args.nclass
-    for c in range(args.nclass):
-        idx_from = ipc * c
-        idx_to = ipc * (c + 1)
-        data_ = data[idx_from:idx_to].detach()
-        target_ = target[idx_from:idx_to].detach()
-        data_, target_ = decode_fn(data_,
-                                   target_,
-                                   args.factor,
-                                   args.decode_type,
-                                   bound=args.batch_syn_max)
-        data_dec.append(data_)
-        target_dec.append(target_)
-
-    data_dec = torch.cat(data_dec)
-    target_dec = torch.cat(target_dec)
+    # Bounded decoding is only used during condensation
+    decode_type = 'multi' if args.decode_type == 'multi' else 'single'
+    data_dec, target_dec = formation.decode_cached(data,
+                                                   target,
+                                                   args.factor,
+                                                   decode_type=decode_type,
+                                                   nclass=args.nclass)
 
     print("Dataset is decoded! ", data_dec.shape)
     save_img('./results/test_dec.png', data_dec, unnormalize=False, dataname=args.dataset)
@@ -304,7 +262,7 @@ def load_data_path(args):
             train_transform, _ = transform_fn(augment=args.augment,
                                               from_tensor=True,
                                               normalize=False)
-            train_dataset = TensorDataset(data, target, train_transform)
+            train_dataset = TensorDataset(data, target, train_transform, normalized=True)
             print("Load condensed data ", args.save_dir, data.shape)
 
         else:
@@ -375,6 +333,25 @@ def load_data_path(args):
     return train_dataset, val_dataset
 
 
+def eval_cache_path(args, train_loader, model_fn, repeat, num_val, fast_eval=False):
+    """Path of the cached results, keyed by the content of the condensed data, the transform,
+       the model function and the evaluation arguments, including the fast_eval setting in effect
+       (None for unsupported loaders)
+    """
+    if not isinstance(train_loader, TensorMemDataLoader):
+        return None
+
+    config = {key: getattr(args, key, None) for key in EVAL_KEYS}
+    config.update(model_fn=model_fn.__name__,
+                  repeat=repeat,
+                  num_val=num_val,
+                  fast_eval=fast_eval,
+                  transform=repr(train_loader.transform),
+                  data=formation.tensor_hash(train_loader.images, train_loader.targets))
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()
+    return os.path.join(EVAL_CACHE_DIR, f'{key}.json')
+
+
 def test_data(args,
               train_loader,
               val_loader,
@@ -382,7 +359,8 @@ def test_data(args,
               model_fn=None,
               repeat=1,
               logger=print,
-              num_val=4):
+              num_val=4,
+              fast_eval=False):
     """Train neural networks on condensed data
     """
 
@@ -395,16 +373,267 @@ def test_data(args,
     else:
         model_fn_ls = [model_fn]
 
+    results = {}
     for model_fn in model_fn_ls:
+        cache_path = None
+        if args.eval_cache:
+            cache_path = eval_cache_path(args,
+                                         train_loader,
+                                         model_fn,
+                                         repeat,
+                                         num_val,
+                                         fast_eval=fast_eval)
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            best_acc_l, acc_l = cached['best_acc'], cached['acc']
+            logger(f"Load cached evaluation of {model_fn.__name__}: {cache_path}")
+            logger(
+                f'Repeat {len(acc_l)} => Best, last acc: {np.mean(best_acc_l):.1f} {np.mean(acc_l):.1f}\n')
+            results[model_fn.__name__] = (best_acc_l, acc_l)
+            continue
+
         best_acc_l = []
         acc_l = []
-        for _ in range(repeat):
-            model = model_fn(args, args.nclass, logger=logger)
-            best_acc, acc = train(args, model, train_loader, val_loader, logger=logger)
-            best_acc_l.append(best_acc)
-            acc_l.append(acc)
+        pred_l = []
+        history_l = []
+        # Single evaluations (e.g., intermediate condensation snapshots) are never repeated
+        adaptive = args.repeat_ci > 0 and repeat > 1
+        if args.ensemble and repeat > 1 and not fast_eval and not adaptive:
+            models = [model_fn(args, args.nclass, logger=logger) for _ in range(repeat)]
+            best_acc_l, acc_l = train_ensemble(args, models, train_loader, val_loader, logger=logger)
+            for i, (best_acc, acc) in enumerate(zip(best_acc_l, acc_l)):
+                logger(f'Model {i} => Best, last acc: {best_acc:.1f} {acc:.1f}')
+            logger(f'Repeat {repeat} => Best, last acc std: {np.std(best_acc_l):.1f} {np.std(acc_l):.1f}')
+        else:
+            # Adaptive repeats: train seeds until the CI of the mean best accuracy is narrow enough
+            n_repeat = max(args.repeat_max, 2) if adaptive else repeat
+            for i in range(n_repeat):
+                model = model_fn(args, args.nclass, logger=logger)
+                history = []
+                best_acc, acc, acc_pred = train(args,
+                                                model,
+                                                train_loader,
+                                                val_loader,
+                                                logger=logger,
+                                                fast_eval=fast_eval,
+                                                history=history)
+                best_acc_l.append(best_acc)
+                acc_l.append(acc)
+                # Runs that were not stopped early observed their last-epoch accuracy
+                pred_l.append(acc if acc_pred is None else acc_pred)
+                history_l.append(history)
+
+                if adaptive and i > 0:
+                    mean, std, ci = mean_ci(best_acc_l)
+                    logger(f'Repeat {i + 1} => Best acc: {mean:.1f} +- {ci:.1f} (std {std:.1f})')
+                    if ci <= args.repeat_ci:
+                        break
+        if adaptive:
+            _, std_best, ci_best = mean_ci(best_acc_l)
+            _, std, ci = mean_ci(acc_l)
+            logger(f'Repeat {len(acc_l)} => Best, last acc std: {std_best:.1f} {std:.1f}, '
+                   f'95% CI: +-{ci_best:.1f} +-{ci:.1f}')
+        if fast_eval and pred_l:
+            logger(f'Repeat {len(acc_l)} => Fast evaluation last acc observed, extrapolated: '
+                   f'{np.mean(acc_l):.1f} {np.mean(pred_l):.1f}')
         logger(
-            f'Repeat {repeat} => Best, last acc: {np.mean(best_acc_l):.1f} {np.mean(acc_l):.1f}\n')
+            f'Repeat {len(acc_l)} => Best, last acc: {np.mean(best_acc_l):.1f} {np.mean(acc_l):.1f}\n')
+        results[model_fn.__name__] = (best_acc_l, acc_l)
+
+        if cache_path is not None:
+            os.makedirs(EVAL_CACHE_DIR, exist_ok=True)
+            with open(cache_path + '.tmp', 'w') as f:
+                json.dump({
+                    'model_fn': model_fn.__name__,
+                    'best_acc': [float(a) for a in best_acc_l],
+                    'acc': [float(a) for a in acc_l],
+                    'history': history_l,
+                }, f)
+            os.replace(cache_path + '.tmp', cache_path)
+
+    return results
+
+
+def eval_jobs(args):
+    """Evaluation jobs (model function name, epochs) of the test.py main
+    """
+    jobs = [('define_model', args.epochs)]
+    if args.dataset[:5] == 'cifar':
+        jobs.append(('resnet10_bn', args.epochs))
+        if (not args.same_compute) and (args.ipc >= 50 and args.factor > 1):
+            jobs.append(('densenet', 400))
+        else:
+            jobs.append(('densenet', args.epochs))
+    elif args.dataset == 'imagenet':
+        jobs.append(('resnet18_bn', args.epochs))
+        jobs.append(('efficientnet', args.epochs))
+    return jobs
+
+
+def eval_loaders(args, train_spec, val_dataset):
+    """Build evaluation loaders in a worker.
+       Condensed tensors are read from the memory-mapped copy saved by parallel_eval.
+    """
+    if train_spec[0] == 'memmap':
+        _, path, transform = train_spec
+        images = torch.from_numpy(np.load(f'{path}_images.npy', mmap_mode='c'))
+        targets = torch.from_numpy(np.load(f'{path}_targets.npy'))
+        train_dataset = TensorDataset(images, targets, transform)
+        train_loader = TensorMemDataLoader(train_dataset, batch_size=args.batch_size)
+    else:
+        train_dataset = train_spec[1]
+        train_loader = MultiEpochsDataLoader(train_dataset,
+                                             batch_size=args.batch_size,
+                                             shuffle=True,
+                                             num_workers=args.workers if args.augment else 0,
+                                             persistent_workers=args.augment > 0)
+    val_loader = MultiEpochsDataLoader(val_dataset,
+                                       batch_size=args.batch_size // 2,
+                                       shuffle=False,
+                                       persistent_workers=True,
+                                       num_workers=4)
+    return train_loader, val_loader
+
+
+def eval_worker(args, job_queue, result_queue, train_spec, val_dataset):
+    """Run evaluation jobs from the queue until None is received.
+       Every job taken is reported: ('start', name, pid) and then its result or error.
+    """
+    import torch.backends.cudnn as cudnn
+    cudnn.benchmark = True
+
+    model_fns = {
+        'define_model': define_model,
+        'resnet10_bn': resnet10_bn,
+        'resnet18_bn': resnet18_bn,
+        'densenet': densenet,
+        'efficientnet': efficientnet,
+    }
+    loaders, error = None, None
+    try:
+        loaders = eval_loaders(args, train_spec, val_dataset)
+    except Exception as e:
+        error = f'loader: {repr(e)}'
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+
+        name, epochs = job
+        result_queue.put(('start', name, os.getpid()))
+        if loaders is None:
+            result_queue.put((name, epochs, None, error))
+            continue
+
+        args.epochs = epochs
+        logger = lambda s: print(f'[{name}] {s}', flush=True)
+        try:
+            results = test_data(args,
+                                loaders[0],
+                                loaders[1],
+                                repeat=args.repeat,
+                                model_fn=model_fns[name],
+                                logger=logger)
+            result_queue.put((name, epochs, results[name], None))
+        except Exception as e:
+            result_queue.put((name, epochs, None, repr(e)))
+
+
+def parallel_eval(args, train_dataset, val_dataset, logger=print, poll=10):
+    """Run the evaluation jobs concurrently in worker processes assigned round-robin to the visible
+       GPUs (--eval_workers, default: one per job up to the number of CPU cores), and summarize
+       the results.
+       Jobs of workers that die (e.g., killed for OOM) are reported as failed.
+    """
+    start = time.time()
+    jobs = eval_jobs(args)
+
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible:
+        devices = visible.split(',')
+    else:
+        devices = [str(i) for i in range(max(1, torch.cuda.device_count()))]
+    n_worker = args.eval_workers if args.eval_workers > 0 else (os.cpu_count() or 1)
+    n_worker = min(n_worker, len(jobs))
+
+    # Workers share a memory-mapped copy of the (decoded) condensed data
+    if isinstance(train_dataset, TensorDataset):
+        path = os.path.join(EVAL_DIR,
+                            formation.tensor_hash(train_dataset.images, train_dataset.targets))
+        if not os.path.isfile(f'{path}_images.npy'):
+            os.makedirs(EVAL_DIR, exist_ok=True)
+            np.save(f'{path}_targets.npy', train_dataset.targets.numpy())
+            np.save(f'{path}_images.tmp.npy', train_dataset.images.numpy())
+            os.replace(f'{path}_images.tmp.npy', f'{path}_images.npy')
+        train_spec = ('memmap', path, train_dataset.transform)
+    else:
+        train_spec = ('dataset', train_dataset)
+
+    ctx = mp.get_context('spawn')
+    job_queue = ctx.Queue()
+    result_queue = ctx.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in range(n_worker):
+        job_queue.put(None)
+
+    workers = []
+    for i in range(n_worker):
+        # The device of a worker is fixed before its CUDA initialization
+        os.environ['CUDA_VISIBLE_DEVICES'] = devices[i % len(devices)]
+        worker = ctx.Process(target=eval_worker,
+                             args=(args, job_queue, result_queue, train_spec, val_dataset))
+        worker.start()
+        workers.append(worker)
+    if visible is None:
+        del os.environ['CUDA_VISIBLE_DEVICES']
+    else:
+        os.environ['CUDA_VISIBLE_DEVICES'] = visible
+    logger(f"Evaluate {len(jobs)} architectures with {n_worker} workers on devices {devices}")
+
+    results = {}
+    running = {}  # pid -> job name
+    epochs_of = dict(jobs)
+    while len(results) < len(jobs):
+        try:
+            msg = result_queue.get(timeout=poll)
+        except queue.Empty:
+            msg = None
+
+        if msg is not None and msg[0] == 'start':
+            running[msg[2]] = msg[1]
+        elif msg is not None:
+            name, epochs, result, error = msg
+            results[name] = (epochs, result, error)
+            running = {pid: n for pid, n in running.items() if n != name}
+        else:
+            # Jobs of dead workers never report
+            for worker in workers:
+                if not worker.is_alive() and worker.pid in running:
+                    name = running.pop(worker.pid)
+                    results[name] = (epochs_of[name], None,
+                                     f'worker died (exit code {worker.exitcode})')
+            if not any(worker.is_alive() for worker in workers):
+                for name, epochs in jobs:
+                    if name not in results:
+                        results[name] = (epochs, None, 'no live worker')
+    for worker in workers:
+        worker.join()
+
+    logger(f"\nSummary ({args.save_dir})")
+    for name, _ in jobs:
+        epochs, result, error = results[name]
+        if error is not None:
+            logger(f'{name:<14} (epochs {epochs}) => failed: {error}')
+            continue
+        best_acc_l, acc_l = result
+        logger(f'{name:<14} (epochs {epochs}) => Best, last acc: '
+               f'{np.mean(best_acc_l):.1f} {np.mean(acc_l):.1f} '
+               f'(std {np.std(best_acc_l):.1f} {np.std(acc_l):.1f}, repeat {len(acc_l)})')
+    logger(f"Wall time: {time.time() - start:.0f}s")
+    return results
 
 
 if __name__ == '__main__':
@@ -424,11 +653,30 @@ if __name__ == '__main__':
         else:
             train_dataset, val_dataset = load_data_path(args)
 
-        train_loader = MultiEpochsDataLoader(train_dataset,
-                                             batch_size=args.batch_size,
-                                             shuffle=True,
-                                             num_workers=args.workers if args.augment else 0,
-                                             persistent_workers=args.augment > 0)
+        if args.parallel_eval:
+            parallel_eval(args, train_dataset, val_dataset)
+            continue
+
+        if args.proxy != 'none' and isinstance(train_dataset, TensorDataset):
+            val_loader = MultiEpochsDataLoader(val_dataset,
+                                               batch_size=args.batch_size // 2,
+                                               shuffle=False,
+                                               num_workers=4)
+            proxy_eval(args,
+                       train_dataset.images,
+                       train_dataset.targets,
+                       val_loader,
+                       normalized=train_dataset.normalized)
+            continue
+
+        if isinstance(train_dataset, TensorDataset):
+            train_loader = TensorMemDataLoader(train_dataset, batch_size=args.batch_size)
+        else:
+            train_loader = MultiEpochsDataLoader(train_dataset,
+                                                 batch_size=args.batch_size,
+                                                 shuffle=True,
+                                                 num_workers=args.workers if args.augment else 0,
+                                                 persistent_workers=args.augment > 0)
         val_loader = MultiEpochsDataLoader(val_dataset,
                                            batch_size=args.batch_size // 2,
                                            shuffle=False,
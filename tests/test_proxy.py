@@ -0,0 +1,45 @@
+import argparse
+import pytest
+
+torch = pytest.importorskip('torch')
+pytestmark = pytest.mark.skipif(not torch.cuda.is_available(), reason='proxies run on GPUs')
+
+
+def make_args():
+    return argparse.Namespace(dataset='cifar10',
+                              nclass=4,
+                              net_type='convnet',
+                              depth=3,
+                              width=0.25,
+                              norm_type='instance',
+                              nch=3,
+                              size=32,
+                              val_cache='none')
+
+
+def test_kernel_proxy_normalized_input():
+    """Normalized and unnormalized copies of the same data give the same proxy accuracy"""
+    from proxy import normalize, kernel_proxy
+
+    args = make_args()
+    torch.manual_seed(0)
+    data = torch.rand(20, 3, 32, 32)
+    target = torch.arange(4).repeat_interleave(5)
+    data_norm = normalize(args, data)
+
+    val_input = normalize(args, torch.rand(40, 3, 32, 32))
+    val_loader = [(val_input[i:i + 10], torch.arange(4).repeat(10)[i:i + 10])
+                  for i in range(0, 40, 10)]
+
+    acc = kernel_proxy(args, data, target, val_loader, n_model=1, logger=lambda s: None)
+    acc_norm = kernel_proxy(args,
+                            data_norm,
+                            target,
+                            val_loader,
+                            n_model=1,
+                            normalized=True,
+                            logger=lambda s: None)
+    assert acc == pytest.approx(acc_norm)
+
+    # Normalizing the normalized copy again changes the inputs of the proxy
+    assert not torch.allclose(normalize(args, data_norm), data_norm)
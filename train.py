@@ -1,9 +1,11 @@
 # original code: https://github.com/dyhan0920/PyramidNet-PyTorch/blob/master/train.py
 import os
+import copy
 import time
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim as optim
@@ -12,8 +14,9 @@ import models.resnet as RN
 import models.resnet_ap as RNAP
 import models.convnet as CN
 import models.densenet_cifar as DN
-from data import load_data, MEANS, STDS
-from misc.utils import random_indices, rand_bbox, AverageMeter, accuracy, get_time, Plotter
+from data import load_data, load_val_cache, load_val_subset, TensorMemDataLoader, MEANS, STDS
+from misc.utils import random_indices, rand_bbox, AverageMeter, DeviceMeter, accuracy_counts, get_time, Plotter
+from misc.utils import fit_learning_curve
 from misc.augment import DiffAug
 from efficientnet_pytorch import EfficientNet
 import time
@@ -92,22 +95,36 @@ def main(args, logger, repeat=1):
         plotter = Plotter(args.save_dir, args.epochs, idx=i)
         model = define_model(args, nclass, logger)
 
-        best_acc, acc = train(args, model, train_loader, val_loader, plotter, logger)
+        best_acc, acc, _ = train(args, model, train_loader, val_loader, plotter, logger)
         best_acc_l.append(best_acc)
         acc_l.append(acc)
 
     logger(f'\n(Repeat {repeat}) Best, last acc: {np.mean(best_acc_l):.1f} {np.mean(acc_l):.1f}')
 
 
-def train(args, model, train_loader, val_loader, plotter=None, logger=None):
+def train(args,
+          model,
+          train_loader,
+          val_loader,
+          plotter=None,
+          logger=None,
+          fast_eval=False,
+          history=None):
+    """Train and validate a model.
+       With fast_eval, the model is validated more often after the last learning rate decay and
+       training stops once the accuracy extrapolated from the curve since that decay to the last
+       epoch is within args.fast_eval_tol. Validation results are appended to history when given.
+       Returns the best and last top-1 accuracies, and the extrapolated last-epoch accuracy
+       (None unless training stopped early).
+    """
     criterion = nn.CrossEntropyLoss().cuda()
     optimizer = optim.SGD(model.parameters(),
                           args.lr,
                           momentum=args.momentum,
                           weight_decay=args.weight_decay)
 
-    scheduler = optim.lr_scheduler.MultiStepLR(
-        optimizer, milestones=[2 * args.epochs // 3, 5 * args.epochs // 6], gamma=0.2)
+    milestones = [2 * args.epochs // 3, 5 * args.epochs // 6]
+    scheduler = optim.lr_scheduler.MultiStepLR(optimizer, milestones=milestones, gamma=0.2)
 
     # Load pretrained
     cur_epoch, best_acc1, best_acc5, acc1, acc5 = 0, 0, 0, 0, 0
@@ -125,6 +142,15 @@ def train(args, model, train_loader, val_loader, plotter=None, logger=None):
         aug = None
         logger(f"Start training with base augmentation and {args.mixup} mixup")
 
+    val_freq = args.epoch_print_freq
+    acc_pred = None
+    if fast_eval:
+        # Accuracy jumps at each decay, so only the curve after the last one is extrapolated
+        decay_last = milestones[-1]
+        val_freq = max(1, args.epochs // args.fast_eval_num_val)
+        val_freq_tail = max(1, (args.epochs - decay_last) // args.fast_eval_num_val)
+        curve_epoch, curve_acc = [], []
+
     # Start training and validation
     # print(get_time())
     for epoch in range(cur_epoch + 1, args.epochs + 1):
@@ -138,11 +164,36 @@ def train(args, model, train_loader, val_loader, plotter=None, logger=None):
                                           aug,
                                           mixup=args.mixup)
 
-        if epoch % args.epoch_print_freq == 0:
-            acc1, acc5, loss_val = validate(args, val_loader, model, criterion, epoch, logger)
+        validate_now = epoch % val_freq == 0
+        if fast_eval and epoch > decay_last:
+            validate_now = ((epoch - decay_last) % val_freq_tail == 0) or (epoch == args.epochs)
+
+        if validate_now:
+            log_val = logger if epoch % args.epoch_print_freq == 0 else None
+            # Intermediate validations may use a subset, the last epoch uses the full set
+            subset = epoch < args.epochs
+            acc1, acc5, loss_val = validate(args,
+                                            val_loader,
+                                            model,
+                                            criterion,
+                                            epoch,
+                                            log_val,
+                                            subset=subset)
+            if subset and args.val_subset > 0 and args.val_full_best and acc1 > best_acc1:
+                # Confirm a new best model on the full set
+                acc1, acc5, loss_val = validate(args, val_loader, model, criterion, epoch, log_val)
 
             if plotter != None:
                 plotter.update(epoch, acc1_tr, acc1, loss_tr, loss_val)
+            if history is not None:
+                history.append({
+                    'epoch': epoch,
+                    'acc_tr': float(acc1_tr),
+                    'loss_tr': float(loss_tr),
+                    'acc1': float(acc1),
+                    'acc5': float(acc5),
+                    'loss': float(loss_val),
+                })
 
             is_best = acc1 > best_acc1
             if is_best:
@@ -151,6 +202,19 @@ def train(args, model, train_loader, val_loader, plotter=None, logger=None):
                 if logger != None:
                     logger(f'Best accuracy (top-1 and 5): {best_acc1:.1f} {best_acc5:.1f}')
 
+            if fast_eval and epoch > decay_last:
+                curve_epoch.append(epoch - decay_last)
+                curve_acc.append(acc1)
+                if len(curve_epoch) >= 4 and epoch < args.epochs:
+                    pred = fit_learning_curve(curve_epoch, curve_acc, args.epochs - decay_last)
+                    if pred - best_acc1 <= args.fast_eval_tol:
+                        acc_pred = pred
+                        if logger != None:
+                            logger(f'Fast evaluation stop at epoch {epoch}/{args.epochs}: '
+                                   f'observed acc {acc1:.1f} (best {best_acc1:.1f}), '
+                                   f'extrapolated acc {acc_pred:.1f}')
+                        break
+
         if args.save_ckpt and (is_best or (epoch == args.epochs)):
             state = {
                 'epoch': epoch,
@@ -163,7 +227,7 @@ def train(args, model, train_loader, val_loader, plotter=None, logger=None):
             save_checkpoint(args.save_dir, state, is_best)
         scheduler.step()
 
-    return best_acc1, acc1
+    return best_acc1, acc1, acc_pred
 
 
 def train_epoch(args,
@@ -181,6 +245,8 @@ def train_epoch(args,
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
+    # Loss, top-1 and top-5 sums on the device (reported to the meters above)
+    metrics = DeviceMeter()
 
     model.train()
 
@@ -188,8 +254,8 @@ def train_epoch(args,
     num_exp = 0
     for i, (input, target) in enumerate(train_loader):
         if train_loader.device == 'cpu':
-            input = input.cuda()
-            target = target.cuda()
+            input = input.cuda(non_blocking=True)
+            target = target.cuda(non_blocking=True)
 
         data_time.update(time.time() - end)
 
@@ -216,11 +282,10 @@ def train_epoch(args,
             loss = criterion(output, target)
 
         # measure accuracy and record loss
-        acc1, acc5 = accuracy(output.data, target, topk=(1, 5))
-
-        losses.update(loss.item(), input.size(0))
-        top1.update(acc1.item(), input.size(0))
-        top5.update(acc5.item(), input.size(0))
+        correct = accuracy_counts(output.data, target, maxk=5)
+        metrics.update(
+            torch.stack([loss.detach() * input.size(0), 100. * correct[0], 100. * correct[4]]),
+            input.size(0))
 
         # compute gradient and do SGD step
         optimizer.zero_grad()
@@ -232,6 +297,7 @@ def train_epoch(args,
         end = time.time()
 
         if i % args.print_freq == 0 and args.verbose == True:
+            metrics.flush(losses, top1, top5)
             print('Epoch: [{0}/{1}][{2}/{3}]\t'
                   'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
                   'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'
@@ -250,6 +316,7 @@ def train_epoch(args,
         num_exp += len(target)
         if (n_data > 0) and (num_exp >= n_data):
             break
+    metrics.flush(losses, top1, top5)
 
     if (epoch % args.epoch_print_freq == 0) and (logger is not None):
         logger(
@@ -259,54 +326,256 @@ def train_epoch(args,
     return top1.avg, top5.avg, losses.avg
 
 
-def validate(args, val_loader, model, criterion, epoch, logger=None):
+def validate(args, val_loader, model, criterion, epoch, logger=None, subset=False):
+    """Validate the model (subset: on the fixed stratified subset of args.val_subset samples)
+    """
     batch_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
+    metrics = DeviceMeter()
+
+    if args.val_cache != 'none':
+        val_loader = load_val_cache(val_loader,
+                                    args.dataset,
+                                    batch_size=args.val_batch_size,
+                                    dtype=args.val_cache)
+    subset = subset and args.val_subset > 0
+    if subset:
+        val_loader = load_val_subset(val_loader, args.val_subset, seed=args.val_subset_seed)
 
     # switch to evaluate mode
     model.eval()
 
     end = time.time()
-    for i, (input, target) in enumerate(val_loader):
-        input = input.cuda()
-        target = target.cuda()
-        output = model(input)
+    with torch.no_grad():
+        for i, (input, target) in enumerate(val_loader):
+            input = input.cuda()
+            target = target.cuda()
+            output = model(input)
 
-        loss = criterion(output, target)
+            loss = criterion(output, target)
 
-        # measure accuracy and record loss
-        acc1, acc5 = accuracy(output.data, target, topk=(1, 5))
+            # measure accuracy and record loss
+            correct = accuracy_counts(output.data, target, maxk=5)
+            metrics.update(
+                torch.stack([loss * input.size(0), 100. * correct[0], 100. * correct[4]]),
+                input.size(0))
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0 and args.verbose == True:
+                metrics.flush(losses, top1, top5)
+                print('Test (on val set): [{0}/{1}][{2}/{3}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'Top 1-acc {top1.val:.4f} ({top1.avg:.4f})\t'
+                      'Top 5-acc {top5.val:.4f} ({top5.avg:.4f})'.format(epoch,
+                                                                         args.epochs,
+                                                                         i,
+                                                                         len(val_loader),
+                                                                         batch_time=batch_time,
+                                                                         loss=losses,
+                                                                         top1=top1,
+                                                                         top5=top5))
+    metrics.flush(losses, top1, top5)
 
-        losses.update(loss.item(), input.size(0))
+    if logger is not None:
+        msg = '(Test ) [Epoch {0}/{1}] {2} Top1 {top1.avg:.1f}  Top5 {top5.avg:.1f}  Loss {loss.avg:.3f}'
+        msg = msg.format(epoch, args.epochs, get_time(), top1=top1, top5=top5, loss=losses)
+        if subset:
+            # 95% confidence interval of the top-1 accuracy (normal approximation)
+            p = top1.avg / 100.
+            ci = 196. * np.sqrt(p * (1 - p) / max(top1.count, 1))
+            msg += f'  (subset {top1.count}, 95% CI +-{ci:.1f})'
+        logger(msg)
+    return top1.avg, top5.avg, losses.avg
 
-        top1.update(acc1.item(), input.size(0))
-        top5.update(acc5.item(), input.size(0))
 
-        # measure elapsed time
-        batch_time.update(time.time() - end)
-        end = time.time()
+def ensemble_supported(model, train_loader):
+    """Lockstep training needs device-resident data and no BatchNorm running statistics
+    """
+    has_bn = any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules())
+    return isinstance(train_loader, TensorMemDataLoader) and not has_bn
 
-        if i % args.print_freq == 0 and args.verbose == True:
-            print('Test (on val set): [{0}/{1}][{2}/{3}]\t'
-                  'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                  'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
-                  'Top 1-acc {top1.val:.4f} ({top1.avg:.4f})\t'
-                  'Top 5-acc {top5.val:.4f} ({top5.avg:.4f})'.format(epoch,
-                                                                     args.epochs,
-                                                                     i,
-                                                                     len(val_loader),
-                                                                     batch_time=batch_time,
-                                                                     loss=losses,
-                                                                     top1=top1,
-                                                                     top5=top5))
 
+def cutmix_ensemble(args, input, target):
+    """CutMix with the mixing decision, box and pairing drawn per model (input: R x B x C x W x H)
+    """
+    n_model, n, _, w, h = input.shape
+    device = input.device
+    apply = torch.rand(n_model, device=device) < args.mix_p
+    lam = torch.distributions.Beta(args.beta, args.beta).sample((n_model, )).to(device)
+
+    cut_rat = torch.sqrt(1. - lam)
+    cut_w = (w * cut_rat).long()
+    cut_h = (h * cut_rat).long()
+    cx = torch.randint(w, (n_model, ), device=device)
+    cy = torch.randint(h, (n_model, ), device=device)
+    bbx1 = torch.clamp(cx - cut_w // 2, 0, w).reshape(-1, 1, 1)
+    bby1 = torch.clamp(cy - cut_h // 2, 0, h).reshape(-1, 1, 1)
+    bbx2 = torch.clamp(cx + cut_w // 2, 0, w).reshape(-1, 1, 1)
+    bby2 = torch.clamp(cy + cut_h // 2, 0, h).reshape(-1, 1, 1)
+
+    rows = torch.arange(w, device=device).reshape(1, -1, 1)
+    cols = torch.arange(h, device=device).reshape(1, 1, -1)
+    box = (rows >= bbx1) & (rows < bbx2) & (cols >= bby1) & (cols < bby2)
+    box = box & apply.reshape(-1, 1, 1)
+
+    rand_index = torch.argsort(torch.rand(n_model, n, device=device), dim=1)
+    input_b = torch.gather(input, 1, rand_index.reshape(n_model, n, 1, 1, 1).expand_as(input))
+    input = torch.where(box.unsqueeze(1).unsqueeze(1), input_b, input)
+    target_b = torch.gather(target, 1, rand_index)
+    ratio = 1 - box.sum(dim=(1, 2)).float() / (w * h)
+
+    return input, target_b, ratio
+
+
+def topk_counts(output, target, topk=(1, 5)):
+    """Number of correct top-k predictions per model (output: R x B x nclass)
+    """
+    maxk = min(max(topk), output.size(-1))
+    pred = output.topk(maxk, dim=-1).indices
+    correct = pred == target.unsqueeze(-1)
+    return [correct[..., :min(k, maxk)].any(-1).float().sum(-1) for k in topk]
+
+
+def train_ensemble(args, models, train_loader, val_loader, logger=None):
+    """Train models of the same architecture in lockstep with stacked parameters (torch.func.vmap).
+       Each model has its own data order and its own augmentation and CutMix draws.
+       Returns the best and last top-1 accuracies of the models.
+    """
+    if args.pretrained or not ensemble_supported(models[0], train_loader):
+        if logger is not None:
+            logger("Ensemble training is not supported for this setting, train models sequentially")
+        results = [train(args, model, train_loader, val_loader, logger=logger) for model in models]
+        return [r[0] for r in results], [r[1] for r in results]
+
+    from torch.func import stack_module_state, functional_call, vmap
+
+    n_model = len(models)
+    models = [model.cuda() for model in models]
+    params, buffers = stack_module_state(models)
+    base = copy.deepcopy(models[0]).to('meta')
+
+    def fmodel(params, buffers, input):
+        return functional_call(base, (params, buffers), (input, ))
+
+    forward = vmap(fmodel, randomness='different')
+    forward_shared = vmap(fmodel, in_dims=(0, 0, None), randomness='different')
+
+    # SGD on the stacked tensors is elementwise, i.e., independent for each model
+    optimizer = optim.SGD(params.values(),
+                          args.lr,
+                          momentum=args.momentum,
+                          weight_decay=args.weight_decay)
+    scheduler = optim.lr_scheduler.MultiStepLR(
+        optimizer, milestones=[2 * args.epochs // 3, 5 * args.epochs // 6], gamma=0.2)
+
+    if args.dsa:
+        aug = DiffAug(strategy=args.dsa_strategy, batch=False)
+        logger(f"Start ensemble training ({n_model} models) with DSA and {args.mixup} mixup")
+    else:
+        aug = None
+        logger(f"Start ensemble training ({n_model} models) with base augmentation and {args.mixup} mixup")
+
+    images, targets = train_loader.images, train_loader.targets
+    n_data = len(images)
+    batch_size = train_loader.batch_size
+
+    best_acc1 = [0.] * n_model
+    acc1 = [0.] * n_model
+    for epoch in range(1, args.epochs + 1):
+        base.train()
+        losses = torch.zeros(n_model, device=images.device)
+        correct1 = torch.zeros(n_model, device=images.device)
+        correct5 = torch.zeros(n_model, device=images.device)
+
+        perm = torch.argsort(torch.rand(n_model, n_data, device=images.device), dim=1)
+        for i in range(0, n_data, batch_size):
+            idx = perm[:, i:i + batch_size]
+            n = idx.size(1)
+            target = targets[idx]
+            with torch.no_grad():
+                input = images[idx.reshape(-1)]
+                if train_loader.transform != None:
+                    input = train_loader.transform(input)
+                if aug != None:
+                    input = aug(input)
+                input = input.reshape(n_model, n, *input.shape[1:])
+
+            if args.mixup == 'cut':
+                input, target_b, ratio = cutmix_ensemble(args, input, target)
+
+            output = forward(params, buffers, input)
+            loss = F.cross_entropy(output.flatten(0, 1), target.reshape(-1), reduction='none')
+            loss = loss.reshape(n_model, n).mean(1)
+            if args.mixup == 'cut':
+                loss_b = F.cross_entropy(output.flatten(0, 1), target_b.reshape(-1), reduction='none')
+                loss = loss * ratio + loss_b.reshape(n_model, n).mean(1) * (1. - ratio)
+
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+
+            with torch.no_grad():
+                c1, c5 = topk_counts(output, target)
+                correct1 += c1
+                correct5 += c5
+                losses += loss.detach() * n
+
+        if epoch % args.epoch_print_freq == 0:
+            if logger is not None:
+                logger('(Train) [Epoch {0}/{1}] {2} Top1 {3:.1f}  Top5 {4:.1f}  Loss {5:.3f} (mean)'.format(
+                    epoch, args.epochs, get_time(), 100. * correct1.mean().item() / n_data,
+                    100. * correct5.mean().item() / n_data,
+                    losses.mean().item() / n_data))
+
+            base.eval()
+            acc1, _, _ = validate_ensemble(args, val_loader, forward_shared, params, buffers, epoch,
+                                           logger)
+            best_acc1 = [max(b, a) for b, a in zip(best_acc1, acc1)]
+        scheduler.step()
+
+    return best_acc1, acc1
+
+
+def validate_ensemble(args, val_loader, forward, params, buffers, epoch, logger=None):
+    """Validate stacked models; forward maps (params, buffers, input) to R x B x nclass outputs
+    """
+    if args.val_cache != 'none':
+        val_loader = load_val_cache(val_loader,
+                                    args.dataset,
+                                    batch_size=args.val_batch_size,
+                                    dtype=args.val_cache)
+
+    losses, correct1, correct5 = 0., 0., 0.
+    n_data = 0
+    with torch.no_grad():
+        for input, target in val_loader:
+            input = input.cuda()
+            target = target.cuda()
+            output = forward(params, buffers, input)
+
+            loss = F.cross_entropy(output.flatten(0, 1),
+                                   target.repeat(output.size(0)),
+                                   reduction='none')
+            c1, c5 = topk_counts(output, target.unsqueeze(0))
+            losses += loss.reshape(output.size(0), -1).sum(1)
+            correct1 += c1
+            correct5 += c5
+            n_data += len(target)
+
+    top1 = (100. * correct1 / n_data).tolist()
+    top5 = (100. * correct5 / n_data).tolist()
+    loss = (losses / n_data).tolist()
     if logger is not None:
-        logger(
-            '(Test ) [Epoch {0}/{1}] {2} Top1 {top1.avg:.1f}  Top5 {top5.avg:.1f}  Loss {loss.avg:.3f}'
-            .format(epoch, args.epochs, get_time(), top1=top1, top5=top5, loss=losses))
-    return top1.avg, top5.avg, losses.avg
+        logger('(Test ) [Epoch {0}/{1}] {2} Top1 {3}  Top5 {4:.1f}  Loss {5:.3f} (mean)'.format(
+            epoch, args.epochs, get_time(), ' '.join(f'{a:.1f}' for a in top1), np.mean(top5),
+            np.mean(loss)))
+    return top1, top5, loss
 
 
 def load_checkpoint(path, model, optimizer):